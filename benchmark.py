@@ -0,0 +1,266 @@
+
+import sys
+import os
+import io
+import math
+import json
+import time
+import random
+import argparse
+import platform
+import statistics
+import tempfile
+import functools
+import numpy as np
+import torch
+import PIL.Image
+
+from sdUtils import tinyModels
+
+
+
+# tiny models run a whole request in milliseconds, sizes are kept small so the suite finishes in a minute on CPU
+WIDTH, HEIGHT = 64, 64
+N_STEPS = 4
+PROMPT = 'a photograph of an astronaut riding a horse'
+
+
+def seedEverything (seed=0):
+	random.seed(seed)
+	np.random.seed(seed)
+	torch.manual_seed(seed)
+
+
+def measure (fn, repeat, warmup=1):
+	for _ in range(warmup):
+		seedEverything()
+		fn()
+
+	times = []
+	for _ in range(repeat):
+		seedEverything()
+		start = time.perf_counter()
+		fn()
+		times.append(time.perf_counter() - start)
+
+	return dict(median=statistics.median(times), mean=statistics.mean(times), min=min(times), runs=len(times))
+
+
+def randomImage (width=WIDTH, height=HEIGHT, mode='RGB', seed=0):
+	channels = len(mode)
+	data = np.random.default_rng(seed).integers(0, 256, (height, width, channels), dtype=np.uint8)
+
+	return PIL.Image.fromarray(data, mode)
+
+
+def imageFile (image):
+	fp = io.BytesIO()
+	image.save(fp, 'PNG')
+	fp.seek(0)
+
+	return fp
+
+
+def pipelineBenchmarks ():
+	pipe = tinyModels.buildTinyPipeline()
+	inpaint_pipe = tinyModels.buildTinyPipeline(inpainting=True)
+	# the reduced precision mode of CPU devices, see `ModelRegistry`
+	bf16_pipe = tinyModels.buildTinyPipeline()
+	bf16_pipe.autocast_dtype = torch.bfloat16
+	for p in (pipe, inpaint_pipe, bf16_pipe):
+		p.set_progress_bar_config(disable=True)
+
+	image = randomImage()
+	mask = randomImage(mode='L', seed=1)
+	latents = pipe.sample_noise(4, HEIGHT, WIDTH, generator=torch.Generator().manual_seed(0))
+
+	benchmarks = {
+		'pipeline.generate': lambda p: p.generate(PROMPT, height=HEIGHT, width=WIDTH, num_inference_steps=N_STEPS, output_type='np'),
+		'pipeline.generate_batch4': lambda p: p.generate([PROMPT] * 4, height=HEIGHT, width=WIDTH, num_inference_steps=N_STEPS, output_type='np'),
+		'pipeline.convert': lambda p: p.convert(PROMPT, image, strength=1, num_inference_steps=N_STEPS, output_type='np'),
+		'pipeline.decode': lambda p: p.decode(latents, output_type='np'),
+	}
+
+	results = {name: functools.partial(fn, pipe) for name, fn in benchmarks.items()}
+	results['pipeline.inpaint'] = lambda: inpaint_pipe.inpaint(PROMPT, image, mask, num_inference_steps=N_STEPS, output_type='np')
+	results.update({f'{name}@bfloat16': functools.partial(fn, bf16_pipe) for name, fn in benchmarks.items()})
+
+	# guidance in the first 60% of steps only
+	windowed = lambda: pipe.generate(PROMPT, height=HEIGHT, width=WIDTH, num_inference_steps=N_STEPS, guidance_window=(0, 0.6), output_type='np')
+	results['pipeline.generate@guidance_window'] = windowed
+	# deep UNet blocks every other step, see `featureCache`
+	reusing = lambda: pipe.generate(PROMPT, height=HEIGHT, width=WIDTH, num_inference_steps=N_STEPS, feature_reuse_interval=2, output_type='np')
+	results['pipeline.generate@feature_reuse'] = reusing
+	# a multistep solver from partway through the schedule
+	results['pipeline.convert@dpm_multistep'] = lambda: pipe.convert(PROMPT, image, strength=0.75, num_inference_steps=N_STEPS, scheduler='dpm_multistep', output_type='np')
+
+	# image error of variants against the float32 reference, on the same seeds
+	variants = [(f'{name}@bfloat16', functools.partial(fn, pipe), functools.partial(fn, bf16_pipe)) for name, fn in benchmarks.items()]
+	variants.append(('pipeline.generate@guidance_window', functools.partial(benchmarks['pipeline.generate'], pipe), windowed))
+	variants.append(('pipeline.generate@feature_reuse', functools.partial(benchmarks['pipeline.generate'], pipe), reusing))
+
+	quality = {}
+	for name, reference_fn, fn in variants:
+		seedEverything()
+		reference = reference_fn()['images']
+		seedEverything()
+		images = fn()['images']
+
+		mse = float(np.mean((reference - images) ** 2))
+		quality[name] = dict(psnr=10 * math.log10(1 / mse) if mse > 0 else math.inf, max_abs_error=float(np.abs(reference - images).max()))
+
+	return results, quality
+
+
+def sentenceBenchmarks (directory):
+	from sentenceGen import SentenceGenerator
+	from textGen import SentenceGenerator as SentenceGeneratorV2
+	from transformers.models.bert.tokenization_bert import BasicTokenizer
+
+	with open('corpus/templates.txt', 'r', encoding='utf-8') as file:
+		words = BasicTokenizer(do_lower_case=True).tokenize(file.read())
+
+	fill_mask_path = tinyModels.saveTinyFillMask(os.path.join(directory, 'fill-mask'), words)
+	tokenizer = tinyModels.buildTinyTokenizer()
+	textgen_path = tinyModels.saveTinyTextGenerator(os.path.join(directory, 'textgen'), tokenizer)
+
+	senGen = SentenceGenerator(templates_path='corpus/templates.txt', reserved_path='corpus/reserved.txt', model_path=fill_mask_path)
+	senGen2 = SentenceGeneratorV2(textgen_path, tokenizer)
+
+	return {
+		'sentenceGen.generate': lambda: senGen.generate(),
+		'textGen.generate': lambda: senGen2.generate(length_limit=tokenizer.model_max_length),
+	}, dict(fill_mask_path=fill_mask_path, textgen_path=textgen_path)
+
+
+def httpBenchmarks (fill_mask_path, textgen_path):
+	import main
+
+	# the server runs in this process on the tiny model, without caches or admission limits that would skip work
+	main.DIFFUSER_MODEL_PATH = 'tiny'
+	main.MODEL_NAME = 'tiny'
+	main.DIFFUSER_MODELS = {'tiny': 'tiny', 'tiny-inpainting': 'tiny-inpainting'}
+	main.TEXTGEN_MODEL_PATH = textgen_path
+	main.FILL_MASK_MODEL_PATH = fill_mask_path
+	main.DEVICE = None
+	main.WORKERS = 0
+	main.RESULT_CACHE_SIZE = 0
+	main.ADMISSION_BUDGET = main.ADMISSION_BULK_BUDGET = 0
+	main.EMBEDDING_CACHE_SIZE = 0
+	main.WARMUP = ['diffusion', 'fill_mask', 'textgen']
+	main.setup()
+
+	while main.warmup['status'] in ('pending', 'running'):
+		time.sleep(0.1)
+	assert main.warmup['status'] == 'done', main.warmup['error']
+
+	client = main.app.test_client()
+	image = randomImage()
+	masked = imageFile(randomImage(mode='RGBA'))
+	latents = np.random.default_rng(0).standard_normal((4, HEIGHT // 8, WIDTH // 8), dtype=np.float32).tobytes()
+
+	def request (method, path, **kwargs):
+		response = getattr(client, method)(path, **kwargs)
+		# streamed bodies are produced while read
+		response.get_data()
+		assert response.status_code == 200, f'{path}: {response.status_code} {response.get_data(as_text=True)[:200]}'
+
+	query = f'prompt={PROMPT}&w={WIDTH}&h={HEIGHT}&n_steps={N_STEPS}'
+
+	return {
+		'http.paint-by-text': lambda: request('get', f'/paint-by-text?{query}&seed=0'),
+		'http.paint-by-text_multi4': lambda: request('get', f'/paint-by-text?{query}&multi=4&seed=0'),
+		'http.img2img': lambda: request('post', f'/img2img?prompt={PROMPT}&n_steps={N_STEPS}&strength=1&seed=0', data=dict(image=(imageFile(image), 'image.png'))),
+		'http.img2img-batch4': lambda: request('post', f'/img2img-batch?prompt={PROMPT}&n_steps={N_STEPS}&strength=1&seed=0',
+			data=dict(image=[(imageFile(image), f'image{i}.png') for i in range(4)])),
+		'http.inpaint': lambda: request('post', f'/inpaint?prompt={PROMPT}&n_steps={N_STEPS}&model=tiny-inpainting', data=dict(image=(io.BytesIO(masked.getvalue()), 'image.png'))),
+		'http.decode': lambda: request('post', f'/decode?w={WIDTH}&h={HEIGHT}', data=latents),
+		'http.random-sentence': lambda: request('get', '/random-sentence'),
+	}
+
+
+def compare (results, baseline, threshold):
+	# returns names of benchmarks whose median is slower than the baseline by more than `threshold`
+	regressions = []
+
+	print(f'\n{"benchmark":<32}{"median":>12}{"baseline":>12}{"ratio":>10}')
+	for name, result in results.items():
+		base = baseline.get(name)
+		if base is None:
+			print(f'{name:<32}{result["median"] * 1000:>10.2f}ms{"-":>12}{"-":>10}')
+			continue
+
+		ratio = result['median'] / base['median']
+		regressed = ratio > 1 + threshold
+		if regressed:
+			regressions.append(name)
+		print(f'{name:<32}{result["median"] * 1000:>10.2f}ms{base["median"] * 1000:>10.2f}ms{ratio:>9.2f}x{"  REGRESSION" if regressed else ""}')
+
+	return regressions
+
+
+def main (argv):
+	parser = argparse.ArgumentParser(description='Times pipelines, sentence generators and HTTP handlers on CPU with tiny random-weight models.')
+	parser.add_argument('--output', default='benchmark-results.json', help='where to write the results')
+	parser.add_argument('--baseline', help='results of an earlier run to compare with')
+	parser.add_argument('--threshold', type=float, default=0.2, help='relative slowdown of a median counted as a regression')
+	parser.add_argument('--repeat', type=int, default=5, help='timed runs of each benchmark, after one warm-up run')
+	parser.add_argument('--threads', type=int, default=1, help='torch intra-op threads, fixed for comparable timings')
+	parser.add_argument('--filter', default='', help='only run benchmarks whose names contain this')
+	args = parser.parse_args(argv[1:])
+
+	os.chdir(os.path.dirname(os.path.abspath(__file__)))
+	torch.set_num_threads(args.threads)
+
+	# prompts are encoded on every run, as they are for new prompts in production
+	from pipeline_stable_diffusion import StableDiffusionPipeline
+	StableDiffusionPipeline.embedding_cache.resize(0)
+
+	directory = tempfile.mkdtemp(prefix='benchmark-')
+	benchmarks, quality = pipelineBenchmarks()
+	for name, deltas in quality.items():
+		print(f'{name}: PSNR {deltas["psnr"]:.1f}dB against float32, max error {deltas["max_abs_error"]:.4f}')
+	sentence_benchmarks, paths = sentenceBenchmarks(directory)
+	benchmarks.update(sentence_benchmarks)
+	benchmarks.update(httpBenchmarks(**paths))
+
+	results = {}
+	for name, fn in benchmarks.items():
+		if args.filter not in name:
+			continue
+
+		results[name] = measure(fn, args.repeat)
+		print(f'{name}: {results[name]["median"] * 1000:.2f}ms')
+
+	report = {
+		'meta': dict(
+			time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+			python=platform.python_version(),
+			torch=torch.__version__,
+			machine=platform.machine(),
+			processor=platform.processor(),
+			threads=args.threads,
+			repeat=args.repeat,
+		),
+		'results': results,
+		'quality': quality,
+	}
+	with open(args.output, 'w') as file:
+		json.dump(report, file, indent='\t')
+	print('results written to', args.output)
+
+	if args.baseline:
+		with open(args.baseline, 'r') as file:
+			baseline = json.load(file)
+
+		regressions = compare(results, baseline['results'], args.threshold)
+		if regressions:
+			print(f'\n{len(regressions)} regression(s) beyond {args.threshold:.0%}:', ', '.join(regressions))
+			return 1
+
+	return 0
+
+
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
@@ -10,14 +10,21 @@ import PIL.PngImagePlugin
 import piexif
 import base64
 import math
+import time
+import select
+import socket
+import functools
+import threading
 import torch
 import numpy as np
+from werkzeug.exceptions import HTTPException
 #import logging
 
 import env
-from pipeline_stable_diffusion import StableDiffusionPipeline
+from pipeline_stable_diffusion import StableDiffusionPipeline, encodeLatents, SCHEDULERS
 from sentenceGen import SentenceGenerator
 from textGen import SentenceGenerator as SentenceGeneratorV2
+from serving import JobQueue, ResultCache, AdmissionControl, AdmissionRejected, Metrics, LazyModel, ModelRegistry, WorkerPool, loadPipeline, loadTokenizer
 
 
 
@@ -32,13 +39,82 @@ SSL_CONTEXT = eval(os.getenv('SSL_CONTEXT'))
 HF_TOKEN = os.getenv('HF_TOKEN')
 DIFFUSER_MODEL_PATH = os.getenv('DIFFUSER_MODEL_PATH')
 TEXTGEN_MODEL_PATH = os.getenv('TEXTGEN_MODEL_PATH')
+FILL_MASK_MODEL_PATH = os.getenv('FILL_MASK_MODEL_PATH', 'bert-base-uncased')
 DEVICE = os.getenv('DEVICE')
 TEXT_DEVICE_INDEX = os.getenv('TEXT_DEVICE_INDEX')
 
 MODEL_NAME = os.path.basename(DIFFUSER_MODEL_PATH)
 
+# models served besides the default one, as `name=path` or `path` named by its base name
+DIFFUSER_MODELS = {MODEL_NAME: DIFFUSER_MODEL_PATH}
+for entry in filter(None, (entry.strip() for entry in os.getenv('DIFFUSER_MODELS', '').split(','))):
+	name, _, path = entry.rpartition('=')
+	DIFFUSER_MODELS[name or os.path.basename(path)] = path
+
+BATCH_WINDOW_MS = float(os.getenv('BATCH_WINDOW_MS', 50))
+BATCH_SIZE = int(os.getenv('BATCH_SIZE', 4))
+JOB_RETENTION = float(os.getenv('JOB_RETENTION', 600))
+PREVIEW_STEPS = int(os.getenv('PREVIEW_STEPS', 5))
+EMBEDDING_CACHE_SIZE = int(os.getenv('EMBEDDING_CACHE_SIZE', 256))
+RESULT_CACHE_DIR = os.getenv('RESULT_CACHE_DIR', './cache/results')
+RESULT_CACHE_SIZE = float(os.getenv('RESULT_CACHE_SIZE', 1024))
+DECODE_BATCH_SIZE = int(os.getenv('DECODE_BATCH_SIZE', 4))
+ENCODE_THREADS = int(os.getenv('ENCODE_THREADS', 4))
+ADMISSION_BUDGET = float(os.getenv('ADMISSION_BUDGET', 2000))
+ADMISSION_BULK_BUDGET = float(os.getenv('ADMISSION_BULK_BUDGET', 1000))
+METRICS_SYNC = bool(os.getenv('METRICS_SYNC'))
+STEP_BATCH_SIZE = int(os.getenv('STEP_BATCH_SIZE', 8))
+RUNNING_BATCHES = int(os.getenv('RUNNING_BATCHES', 4))
+WORKERS = int(os.getenv('WORKERS', 0))
+WORKER_DEVICES = [device.strip() for device in os.getenv('WORKER_DEVICES', 'cpu').split(',')]
+WORKER_THREADS = int(os.getenv('WORKER_THREADS', 0)) or None
+MODEL_MEMORY_BUDGET = float(os.getenv('MODEL_MEMORY_BUDGET', 0))
+MODEL_EVICTION = os.getenv('MODEL_EVICTION', 'offload')
+SEQUENTIAL_OFFLOAD = bool(os.getenv('SEQUENTIAL_OFFLOAD'))
+VAE_TILING_PIXELS = int(os.getenv('VAE_TILING_PIXELS', 1024 * 1024))
+VAE_TILE_SIZE = int(os.getenv('VAE_TILE_SIZE', 512))
+# `start,end` fractions of denoising steps that run classifier free guidance, the others skip the unconditional branch
+GUIDANCE_WINDOW = tuple(map(float, os.getenv('GUIDANCE_WINDOW').split(','))) if os.getenv('GUIDANCE_WINDOW') else None
+# default scheduler of requests, that of the model if not set
+SCHEDULER = os.getenv('SCHEDULER') or None
+FEATURE_REUSE_INTERVAL = int(os.getenv('FEATURE_REUSE_INTERVAL', 1))
+COMPILE = bool(os.getenv('COMPILE'))
+COMPILE_CACHE_SIZE = int(os.getenv('COMPILE_CACHE_SIZE', 16))
+# request sizes are snapped to these, as `WxH`, so that compiled graphs are reused
+RESOLUTION_BUCKETS = [tuple(map(int, bucket.strip().split('x'))) for bucket in os.getenv('RESOLUTION_BUCKETS', '').split(',') if bucket.strip()]
+WARMUP = [name.strip() for name in os.getenv('WARMUP', 'diffusion').split(',') if name.strip()]
+EVENTS_KEEPALIVE = 15
+DISCONNECT_POLL = 1
+
+LATENTS_DTYPES = {
+	'float32':	torch.float32,
+	'float16':	torch.float16,
+}
+
+MODEL_DTYPES = {
+	'float32':	torch.float32,
+	'float16':	torch.float16,
+	'bfloat16':	torch.bfloat16,
+}
+DTYPE = MODEL_DTYPES[os.getenv('DTYPE', 'float32')]
+
 TEMPERATURE = 4.
 
+# a small paint job run once the diffusion model is loaded
+WARMUP_PAINT = dict(prompt='warm-up', neg_prompt=None, multi=1, n_steps=2, width=512, height=512, img_only=None, ext='png', latents=None)
+
+# lazily loaded components by name, and the state of the background warm-up
+models = {}
+warmup = dict(status='pending', components=[], error=None)
+
+
+metrics = Metrics()
+stageSeconds = metrics.histogram('sd_stage_seconds', 'Time of pipeline and response stages.')
+jobSeconds = metrics.histogram('sd_job_seconds', 'Time of jobs waiting in queue and running, by kind.')
+batchImages = metrics.histogram('sd_batch_images', 'Images in batches dispatched to the pipeline, by kind.', buckets=(1, 2, 4, 8, 16, 32))
+unetBatchImages = metrics.histogram('sd_unet_batch_images', 'Rows in UNet calls, doubled by classifier free guidance.', buckets=(1, 2, 4, 8, 16, 32, 64))
+modelSwitchSeconds = metrics.histogram('sd_model_switch_seconds', 'Time of model loads, restores from and offloads to CPU memory, and unloads, by model and action.')
+
 
 @app.route('/bundles/<path:filename>')
 def bundle(filename):
@@ -72,44 +148,161 @@ def encodeImageToDataURL (image, info=None, ext='.png'):
 		exif = piexif.dump({'0th': {305: json.dumps(info).encode('ascii')}})[6:]
 
 	fp = io.BytesIO()
-	image.save(fp, PIL.Image.registered_extensions()[ext], pnginfo=option, exif=exif)
+	with metrics.timer(stageSeconds, stage='image_encode'):
+		image.save(fp, PIL.Image.registered_extensions()[ext], pnginfo=option, exif=exif)
 
-	return 'data:image/%s;base64,%s' % (ext[1:], base64.b64encode(fp.getvalue()).decode('ascii'))
+	with metrics.timer(stageSeconds, stage='base64'):
+		return 'data:image/%s;base64,%s' % (ext[1:], base64.b64encode(fp.getvalue()).decode('ascii'))
 
 
-@app.route('/paint-by-text', methods=['GET'])
-def paintByText ():
-	prompt = flask.request.args.get('prompt')
+def eventMessage (event, data):
+	return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=True)}\n\n'
+
+
+def jsonResponse (data, status=200):
+	return flask.Response(json.dumps(data, ensure_ascii=True), status=status, mimetype='application/json')
+
+
+def parseLatentsFormat ():
+	# latents are opt-in, `latents` alone means float32
+	format = flask.request.args.get('latents')
+	if format is None:
+		return None
+
+	format = format or 'float32'
+	if format not in LATENTS_DTYPES:
+		flask.abort(400, f'latents should be one of {", ".join(LATENTS_DTYPES)}.')
+
+	return format
+
+
+def latentsURLs (job, result):
+	if result['latents'] is None:
+		return None
+
+	return [f'/jobs/{job.id}/latents?index={i}' for i in range(len(result['latents']))]
+
+
+def parseModel ():
+	model = flask.request.args.get('model') or MODEL_NAME
+	if model not in DIFFUSER_MODELS:
+		flask.abort(400, f'model should be one of {", ".join(DIFFUSER_MODELS)}.')
+
+	return model
+
+
+def checkPrompt (prompt):
+	# a missing prompt would fail the whole batch the request joins
+	if not isinstance(prompt, str) or not prompt.strip():
+		flask.abort(400, 'prompt should be a non-empty string.')
+
+	return prompt
+
+
+def parseGuidanceWindow ():
+	text = flask.request.args.get('guidance_window')
+	if not text:
+		return GUIDANCE_WINDOW
+
+	try:
+		start, end = map(float, text.split(','))
+	except ValueError:
+		flask.abort(400, 'guidance_window should be `start,end` fractions of steps.')
+	if not 0 <= start <= end <= 1:
+		flask.abort(400, 'guidance_window should be `start,end` with 0 <= start <= end <= 1.')
+
+	return start, end
+
+
+def parseFeatureReuse ():
+	interval = int(flask.request.args.get('feature_reuse', FEATURE_REUSE_INTERVAL))
+	if interval < 1:
+		flask.abort(400, 'feature_reuse should be a positive interval of steps.')
+
+	return interval
+
+
+def parseScheduler ():
+	scheduler = flask.request.args.get('scheduler') or SCHEDULER
+	if scheduler is not None and scheduler not in SCHEDULERS:
+		flask.abort(400, f'scheduler should be one of {", ".join(SCHEDULERS)}.')
+
+	return scheduler
+
+
+def modelInfo (model):
+	runner = models['diffusion'].get()
+
+	# worker pools report the default model, Stable Diffusion checkpoints share latent shapes
+	return runner.info(model) if isinstance(runner, ModelRegistry) else runner.info()
+
+
+def snapResolution (width, height):
+	# the bucket closest in aspect ratio, then in area
+	if not RESOLUTION_BUCKETS:
+		return width, height
+
+	return min(RESOLUTION_BUCKETS, key=lambda bucket: (abs(math.log(bucket[0] * height / (bucket[1] * width))), abs(bucket[0] * bucket[1] - width * height)))
+
+
+def outputSettings (model, width, height):
+	# server settings that change output images, for result cache keys, the cache outlives restarts
+	tiled = bool(VAE_TILING_PIXELS) and width * height > VAE_TILING_PIXELS
+	return dict(model_path=DIFFUSER_MODELS[model], dtype=str(DTYPE), vae_tile_size=VAE_TILE_SIZE if tiled else None)
+
+
+def estimateCost (n_images, n_steps, width, height):
+	# in denoising steps of 512x512 images
+	return n_images * n_steps * width * height / 512 ** 2
+
+
+def parsePaintRequest ():
+	prompt = checkPrompt(flask.request.args.get('prompt'))
 	neg_prompt = flask.request.args.get('neg_prompt', None)
 	multi = int(flask.request.args.get('multi', 1))
 	n_steps = int(flask.request.args.get('n_steps', 50))
 	width = int(flask.request.args.get('w', 512))
 	height = int(flask.request.args.get('h', 512))
+	width, height = snapResolution(width, height)
 	img_only = flask.request.args.get('img_only')
 	temperature = float(flask.request.args.get('temperature', 1))
 	seed = flask.request.args.get('seed') and int(flask.request.args.get('seed'))
 	ext = flask.request.args.get('ext', 'png')
+	latents = parseLatentsFormat()
+	model = parseModel()
+	guidance_window = parseGuidanceWindow()
+	feature_reuse = parseFeatureReuse()
+	scheduler = parseScheduler()
 	#print('paint by text:', prompt, multi)
 
-	global senGen, senGen2
+	# random prompts and seeds make the output non-deterministic, and latents URLs are bound to a job
+	deterministic = seed is not None and prompt not in ('**', '***') and latents is None
+
 	if prompt == '***':
-		prompt = senGen2.generate(temperature=temperature)
+		prompt = models['textgen'].get().generate(temperature=temperature)
 	elif prompt == '**':
-		prompt = senGen.generate(temperature=temperature)
+		prompt = models['fill_mask'].get().generate(temperature=temperature)
 
-	global pipe
 	global rand_generator
-
-	if seed is not None:
-		rand_generator.manual_seed(seed)
-	else:
+	if seed is None:
 		seed = rand_generator.seed()
 
-	result = pipe.generate([prompt] * multi, negative_prompt=[neg_prompt] * multi if neg_prompt is not None else None, num_inference_steps=n_steps, width=width, height=height, generator=rand_generator)
+	params = dict(prompt=prompt, neg_prompt=neg_prompt, multi=multi, n_steps=n_steps, width=width, height=height, img_only=img_only, seed=seed, ext=ext,
+		latents=latents, model=model, guidance_window=guidance_window, feature_reuse=feature_reuse, scheduler=scheduler)
+
+	return dict(params=params, key=(model, width, height, n_steps, guidance_window, feature_reuse, scheduler), size=multi, total_steps=n_steps,
+		cache_key=ResultCache.keyOf(dict(params, kind='paint', settings=outputSettings(model, width, height))) if deterministic else None,
+		cost=estimateCost(multi, n_steps, width, height), lane='bulk' if img_only is not None else 'interactive')
+
+
+def formatPaintResult (job, result):
+	params = job.params
+	prompt, seed, ext = params['prompt'], params['seed'], params['ext']
 
-	if img_only is not None:
+	if params['img_only'] is not None:
 		fp = io.BytesIO()
-		result['images'][0].save(fp, PIL.Image.registered_extensions()[f'.{ext}'], quality=100)
+		with metrics.timer(stageSeconds, stage='image_encode'):
+			result['images'][0].save(fp, PIL.Image.registered_extensions()[f'.{ext}'], quality=100)
 
 		res = flask.Response(fp.getvalue(), mimetype = f'image/${ext}')
 
@@ -123,65 +316,84 @@ def paintByText ():
 		'images': [encodeImageToDataURL(img, {
 			'prompt': prompt,
 			'seed': str(seed),
-			'negative_prompt': neg_prompt,
-			'model': MODEL_NAME,
-			'resolution': f'{width}x{height}',
+			'negative_prompt': params['neg_prompt'],
+			'model': params['model'],
+			'resolution': f'{params["width"]}x{params["height"]}',
 		}, ext=f'.{ext}') for img in result['images']],
-		'latents': result['latents'],
+		'latents': latentsURLs(job, result),
 		'seed': seed,
-		'model': MODEL_NAME,
+		'model': params['model'],
 	}
 
 	return flask.Response(json.dumps(result, ensure_ascii=True), mimetype='application/json')
 
 
-@app.route('/img2img', methods=['POST'])
-def img2img ():
-	prompt = flask.request.args.get('prompt')
+def img2imgRequest (imageFile, prompt, seed):
+	# one image of `/img2img` or `/img2img-batch`, the other arguments are shared
 	n_steps = int(flask.request.args.get('n_steps', 50))
 	strength = float(flask.request.args.get('strength', 0.5))
-	seed = flask.request.args.get('seed') and int(flask.request.args.get('seed'))
-
-	imageFile = flask.request.files.get('image')
-	if not imageFile:
-		flask.abort(400, 'image field is requested.')
+	latents = parseLatentsFormat()
+	model = parseModel()
+	guidance_window = parseGuidanceWindow()
+	feature_reuse = parseFeatureReuse()
+	scheduler = parseScheduler()
 
 	image = PIL.Image.open(imageFile.stream)
 
 	PIXELS_SIZE = 640 * 640
 	w, h = image.size
 	scaling = 1 if w * h <= PIXELS_SIZE else math.sqrt(PIXELS_SIZE / (w * h))
-	w, h = round(w * scaling / 64.) * 64, round(h * scaling / 64.) * 64
+	w, h = snapResolution(round(w * scaling / 64.) * 64, round(h * scaling / 64.) * 64)
 	if w != image.size[0] or h != image.size[1]:
 		image = image.resize((w, h), resample=PIL.Image.BICUBIC)
 	#print('image:', image.size, scaling)
 
-	global pipe
 	global rand_generator
-
-	if seed is not None:
-		rand_generator.manual_seed(seed)
-	else:
+	if seed is None:
 		seed = rand_generator.seed()
 
-	result = pipe.convert(prompt, init_image=image, num_inference_steps=n_steps, strength=strength, generator=rand_generator)
+	params = dict(prompt=prompt, image=image, n_steps=n_steps, strength=strength, seed=seed, latents=latents, model=model, guidance_window=guidance_window,
+		feature_reuse=feature_reuse, scheduler=scheduler)
+
+	# images of the same size are encoded and denoised in one batch
+	return dict(params=params, key=(model, w, h, n_steps, strength, guidance_window, feature_reuse, scheduler), total_steps=int(n_steps * strength),
+		cost=estimateCost(1, n_steps * strength, w, h), lane='interactive')
+
+
+def parseImg2imgRequest ():
+	seed = flask.request.args.get('seed') and int(flask.request.args.get('seed'))
+
+	imageFile = flask.request.files.get('image')
+	if not imageFile:
+		flask.abort(400, 'image field is requested.')
+
+	return img2imgRequest(imageFile, checkPrompt(flask.request.args.get('prompt')), seed)
+
+
+def formatImg2imgResult (job, result):
+	params = job.params
+	prompt, seed = params['prompt'], params['seed']
+	latents = latentsURLs(job, result)
 
 	result = {
 		'prompt': prompt,
-		'source': encodeImageToDataURL(image),
-		'image': encodeImageToDataURL(result['images'][0], {'prompt': prompt, 'seed': str(seed), 'model': MODEL_NAME}),
-		'latent': result['latents'][0],
+		'source': encodeImageToDataURL(params['image']),
+		'image': encodeImageToDataURL(result['images'][0], {'prompt': prompt, 'seed': str(seed), 'model': params['model']}),
+		'latent': latents and latents[0],
 		'seed': seed,
 	}
 
 	return flask.Response(json.dumps(result, ensure_ascii=True), mimetype='application/json')
 
 
-@app.route('/inpaint', methods=['POST'])
-def inpaint():
+def parseInpaintRequest ():
 	prompt = flask.request.args.get('prompt')
 	n_steps = int(flask.request.args.get('n_steps', 50))
 	strength = float(flask.request.args.get('strength', 0.5))
+	model = parseModel()
+	guidance_window = parseGuidanceWindow()
+	feature_reuse = parseFeatureReuse()
+	scheduler = parseScheduler()
 
 	imageFile = flask.request.files.get('image')
 	if not imageFile:
@@ -201,9 +413,12 @@ def inpaint():
 	source = PIL.Image.fromarray(data[:, :, :3])
 	mask = PIL.Image.fromarray(255 - data[:, :, 3])
 
-	global pipe
-	result = pipe.inpaint(prompt, image=source, mask_image=mask, num_inference_steps=n_steps)
+	return dict(params=dict(prompt=prompt, image=source, mask=mask, n_steps=n_steps, model=model, guidance_window=guidance_window,
+		feature_reuse=feature_reuse, scheduler=scheduler), total_steps=n_steps,
+		cost=estimateCost(1, n_steps, *source.size), lane='interactive')
+
 
+def formatInpaintResult (job, result):
 	#result_arr = np.array(result['images'][0]).astype(np.float32) / 255.
 	#result_arr = result_arr * (1 - mask_arr) + source_arr * mask_arr
 	#result_arr = (result_arr * 255).astype(np.uint8)
@@ -215,42 +430,519 @@ def inpaint():
 	return flask.Response(fp.getvalue(), mimetype = 'image/png')
 
 
-@app.route('/random-sentence', methods=['GET'])
-def randomSentence ():
-	global senGen
+def parseDecodeRequest ():
+	width = int(flask.request.args.get('w', 512))
+	height = int(flask.request.args.get('h', 512))
+	dtype = flask.request.args.get('dtype', 'float32')
+	ext = flask.request.args.get('ext', 'png')
+	model = parseModel()
+
+	if dtype not in LATENTS_DTYPES:
+		flask.abort(400, f'dtype should be one of {", ".join(LATENTS_DTYPES)}.')
+
+	# latents are raw buffers as served by /jobs/<id>/latents, either as `latents` files or as the request body
+	buffers = [file.read() for file in flask.request.files.getlist('latents')] or [flask.request.get_data()]
+
+	info = modelInfo(model)
+	shape = (info['latent_channels'], height // info['vae_scale_factor'], width // info['vae_scale_factor'])
+	latents = []
+	for buffer in buffers:
+		itemsize = np.dtype(dtype).itemsize
+		if len(buffer) == 0 or len(buffer) % (itemsize * math.prod(shape)) != 0:
+			flask.abort(400, f'latents buffer size does not match shape {shape} of {dtype}.')
+
+		array = np.frombuffer(buffer, dtype=np.dtype(dtype))
+
+		latents.append(torch.from_numpy(array.reshape(-1, *shape).astype(np.float32)))
+
+	latents = torch.cat(latents)
+
+	return dict(params=dict(latents=latents, ext=ext, model=model), key=(model, width, height), size=latents.shape[0])
+
+
+def formatDecodeResult (job, result):
+	ext = job.params['ext']
+
+	return jsonResponse({
+		'images': [encodeImageToDataURL(img, {'model': job.params['model']}, ext=f'.{ext}') for img in result['images']],
+		'model': job.params['model'],
+	})
+
+
+jobKinds = {
+	'paint':	(parsePaintRequest, formatPaintResult),
+	'img2img':	(parseImg2imgRequest, formatImg2imgResult),
+	'inpaint':	(parseInpaintRequest, formatInpaintResult),
+	'decode':	(parseDecodeRequest, formatDecodeResult),
+}
+
+
+def submitJob (kind, request=None):
+	# `request` is given by batch routes, already parsed, their jobs do not join sessions
+	parse, _ = jobKinds[kind]
+	# a newer request of the same session cancels the unfinished one
+	session = flask.request.args.get('session') if request is None else None
+	request = request or parse()
+	cache_key = request.pop('cache_key', None)
+	cost, lane = request.pop('cost', None), request.pop('lane', None)
+
+	global jobQueue, resultCache, admission
+	if cache_key is not None and resultCache is not None:
+		response = resultCache.get(cache_key)
+		if response is not None:
+			return jobQueue.complete(kind, request['params'], dict(response=response), session=session)
+
+	submit = lambda: jobQueue.submit(kind, session=session, **request)
+	if lane is None or admission is None:
+		job = submit()
+	else:
+		try:
+			job = admission.submit(lane, cost, submit)
+		except AdmissionRejected as error:
+			res = jsonResponse({'error': str(error), 'lane': error.lane, 'retry_after': error.retry_after}, status=429)
+			res.headers['Retry-After'] = str(error.retry_after)
+			flask.abort(res)
+
+	job.cache_key = cache_key
+
+	return job
+
+
+def encodeJobResult (job, result):
+	# runs on the job queue's post-processing threads as soon as the batch is done,
+	# keeps the encoded response so it is neither encoded twice nor stored twice
+	_, format = jobKinds[job.kind]
+
+	jobSeconds.observe(job.started - job.arrival, kind=job.kind, phase='queue')
+	jobSeconds.observe(time.time() - job.started, kind=job.kind, phase='run')
+
+	res = format(job, result)
+	headers = {key: value for key, value in res.headers.items() if key not in ('Content-Type', 'Content-Length')}
+	result['response'] = (res.get_data(), res.mimetype, headers)
+
+	# finished jobs are kept for JOB_RETENTION, with the response and requested latents only, not images and input tensors
+	result.pop('images', None)
+	if not isinstance(job.params.get('latents'), str):
+		result.pop('latents', None)
+	job.params = {key: value for key, value in job.params.items() if not isinstance(value, (PIL.Image.Image, torch.Tensor))}
+
+	if job.cache_key is not None and resultCache is not None:
+		resultCache.put(job.cache_key, *result['response'])
+
+	return result
+
 
-	if senGen is None:
-		device = torch.device(f'{DEVICE}:{TEXT_DEVICE_INDEX}') if DEVICE else None
-		senGen = SentenceGenerator(templates_path='corpus/templates.txt', reserved_path='corpus/reserved.txt', device=device)
+def clientDisconnected (connection):
+	# a closed connection reads as EOF, pipelined request data is only peeked
+	try:
+		readable, _, _ = select.select([connection], [], [], 0)
+		return bool(readable) and connection.recv(1, socket.MSG_PEEK) == b''
+	except (ValueError, BlockingIOError):
+		# e.g. SSL sockets do not support peeking
+		return False
+	except OSError:
+		return True
+
+
+def waitForJob (job):
+	# cancel the job if the client goes away while waiting
+	connection = flask.request.environ.get('werkzeug.socket')
+	while not job.event.wait(DISCONNECT_POLL):
+		if connection is not None and clientDisconnected(connection):
+			jobQueue.cancel(job)
+			break
+
+	return job
+
+
+def formatJobResult (job):
+	job.event.wait()
+	if job.status == 'cancelled':
+		return jsonResponse(jobQueue.describe(job), status=410)
+
+	body, mimetype, headers = job.wait()['response']
+	res = flask.Response(body, mimetype=mimetype)
+	res.headers.update(headers)
+
+	return res
+
+
+@app.route('/paint-by-text', methods=['GET'])
+def paintByText ():
+	return formatJobResult(waitForJob(submitJob('paint')))
+
+
+@app.route('/img2img', methods=['POST'])
+def img2img ():
+	return formatJobResult(waitForJob(submitJob('img2img')))
+
+
+@app.route('/img2img-batch', methods=['POST'])
+def img2imgBatch ():
+	# many `image` files with one `prompt` or one per image, results stream back in order as lines of JSON
+	imageFiles = flask.request.files.getlist('image')
+	prompts = flask.request.args.getlist('prompt') or [None]
+	seed = flask.request.args.get('seed') and int(flask.request.args.get('seed'))
+
+	if not imageFiles:
+		flask.abort(400, 'image fields are requested.')
+	if len(prompts) not in (1, len(imageFiles)):
+		flask.abort(400, f'{len(prompts)} prompts for {len(imageFiles)} images, there should be one prompt or one per image.')
+	if len(prompts) == 1:
+		prompts = prompts * len(imageFiles)
+
+	# jobs of images of the same size are batched by the job queue, invalid entries are answered alone and not submitted
+	jobs = []
+	try:
+		for i, (imageFile, prompt) in enumerate(zip(imageFiles, prompts)):
+			try:
+				checkPrompt(prompt)
+			except HTTPException as error:
+				jobs.append(error)
+				continue
+
+			jobs.append(submitJob('img2img', img2imgRequest(imageFile, prompt, seed + i if seed is not None else None)))
+	except HTTPException:
+		# e.g. rejected by admission control, the whole batch is
+		for job in jobs:
+			if not isinstance(job, HTTPException):
+				jobQueue.cancel(job)
+		raise
+
+	def stream ():
+		try:
+			for index, job in enumerate(jobs):
+				if isinstance(job, HTTPException):
+					yield json.dumps(dict(status='invalid', code=job.code, error=job.description, index=index), ensure_ascii=True) + '\n'
+					continue
+
+				job.event.wait()
+				if job.status == 'done':
+					body, _, _ = job.wait()['response']
+					yield json.dumps(dict(json.loads(body), index=index, job=job.id), ensure_ascii=True) + '\n'
+				else:
+					yield json.dumps(dict(jobQueue.describe(job), index=index), ensure_ascii=True) + '\n'
+		finally:
+			# the client is gone before the end
+			for job in jobs:
+				if not isinstance(job, HTTPException) and not job.event.is_set():
+					jobQueue.cancel(job)
+
+	res = flask.Response(stream(), mimetype='application/x-ndjson')
+	res.headers['X-Accel-Buffering'] = 'no'
+
+	return res
+
+
+@app.route('/inpaint', methods=['POST'])
+def inpaint ():
+	return formatJobResult(waitForJob(submitJob('inpaint')))
+
+
+@app.route('/decode', methods=['POST'])
+def decode ():
+	return formatJobResult(waitForJob(submitJob('decode')))
+
+
+@app.route('/jobs/paint-by-text', methods=['GET'])
+def submitPaintByText ():
+	return jsonResponse(jobQueue.describe(submitJob('paint')))
+
+
+@app.route('/jobs/img2img', methods=['POST'])
+def submitImg2img ():
+	return jsonResponse(jobQueue.describe(submitJob('img2img')))
+
+
+@app.route('/jobs/inpaint', methods=['POST'])
+def submitInpaint ():
+	return jsonResponse(jobQueue.describe(submitJob('inpaint')))
+
+
+def getJob (id):
+	job = jobQueue.get(id)
+	if job is None:
+		flask.abort(404, 'Job not found.')
+
+	return job
+
+
+@app.route('/jobs/decode', methods=['POST'])
+def submitDecode ():
+	return jsonResponse(jobQueue.describe(submitJob('decode')))
+
+
+@app.route('/jobs/<id>', methods=['GET'])
+def jobStatus (id):
+	return jsonResponse(jobQueue.describe(getJob(id)))
+
+
+@app.route('/jobs/<id>/cancel', methods=['POST'])
+def cancelJob (id):
+	job = getJob(id)
+	jobQueue.cancel(job)
+
+	return jsonResponse(jobQueue.describe(job))
+
+
+@app.route('/jobs/<id>/result', methods=['GET'])
+def jobResult (id):
+	job = getJob(id)
+
+	if job.status != 'done':
+		return jsonResponse(jobQueue.describe(job), status={'failed': 500, 'cancelled': 410}.get(job.status, 202))
+
+	return formatJobResult(job)
+
+
+@app.route('/jobs/<id>/latents', methods=['GET'])
+def jobLatents (id):
+	job = getJob(id)
+	if job.status != 'done':
+		return jsonResponse(jobQueue.describe(job), status={'failed': 500, 'cancelled': 410}.get(job.status, 202))
+
+	latents = job.result.get('latents')
+	if latents is None:
+		flask.abort(404, 'Latents are not requested by this job.')
+
+	index = flask.request.args.get('index')
+	if index is not None:
+		latents = latents[int(index):int(index) + 1]
+
+	format = job.params['latents']
+	res = flask.Response(encodeLatents(latents, LATENTS_DTYPES[format]), mimetype='application/octet-stream')
+	res.headers['X-Latents-Shape'] = ','.join(map(str, latents.shape))
+	res.headers['X-Latents-Dtype'] = format
+
+	return res
+
+
+@app.route('/jobs/<id>/events', methods=['GET'])
+def jobEvents (id):
+	job = getJob(id)
 
-	return flask.Response(senGen.generate(temperature=TEMPERATURE), mimetype = 'text/plain')
+	def stream ():
+		job.listen()
+		try:
+			version = None
+			preview = None
+			while True:
+				last_version = version
+				version = job.waitForUpdate(version, timeout=EVENTS_KEEPALIVE)
+				if version == last_version:
+					yield ': keep-alive\n\n'
+					continue
+
+				status = jobQueue.describe(job)
+				if job.preview is not preview:
+					preview = job.preview
+					status['previews'] = [encodeImageToDataURL(image) for image in preview]
+
+				if job.status == 'done':
+					yield eventMessage('done', status)
+					break
+				elif job.status in ('failed', 'cancelled'):
+					yield eventMessage('error', status)
+					break
+
+				yield eventMessage('progress', status)
+		finally:
+			job.listen(-1)
+
+	res = flask.Response(stream(), mimetype='text/event-stream')
+	res.headers['Cache-Control'] = 'no-cache'
+	res.headers['X-Accel-Buffering'] = 'no'
+
+	return res
+
+
+@app.route('/metrics', methods=['GET'])
+def metricsPage ():
+	return flask.Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def observeStage (stage, seconds, batch_size):
+	stageSeconds.observe(seconds, stage=stage)
+	if stage == 'unet':
+		unetBatchImages.observe(batch_size)
+
+
+def observeModelSwitch (model, action, seconds):
+	modelSwitchSeconds.observe(seconds, model=model, action=action)
+
+
+def registerMetrics (pool=None):
+	def jobCounts ():
+		counts = {}
+		for job in list(jobQueue.jobs.values()):
+			counts[(job.kind, job.status)] = counts.get((job.kind, job.status), 0) + 1
+
+		return [(dict(kind=kind, status=status), n) for (kind, status), n in counts.items()]
+
+	metrics.sampled('sd_queue_depth', 'Jobs waiting for dispatch.', lambda: len(jobQueue.pending))
+	metrics.sampled('sd_jobs', 'Retained jobs by kind and status.', jobCounts)
+
+	def cacheStats (key):
+		values = []
+		if resultCache is not None:
+			values.append((dict(cache='result'), resultCache.stats()[key]))
+		# embeddings are cached in the worker processes when there is a pool
+		if pool is None:
+			values.append((dict(cache='embedding'), StableDiffusionPipeline.embedding_cache.stats()[key]))
+
+		return values
+
+	metrics.sampled('sd_cache_hits_total', 'Cache hits.', lambda: cacheStats('hits'), type='counter')
+	metrics.sampled('sd_cache_misses_total', 'Cache misses.', lambda: cacheStats('misses'), type='counter')
+
+	if admission is not None:
+		metrics.sampled('sd_admission_load', 'Estimated cost of unfinished admitted jobs, in 512x512 denoising steps.',
+			lambda: [(dict(lane=lane), stats['load']) for lane, stats in admission.stats()['lanes'].items()])
+		metrics.sampled('sd_admission_rate', 'Measured throughput in 512x512 denoising steps per second.', lambda: admission.stats()['rate'])
+
+	def modelBytes ():
+		runner = models['diffusion'].value
+		if not isinstance(runner, ModelRegistry):
+			return []
+
+		return [(dict(model=stats['model'], location=stats['location']), stats['bytes']) for stats in runner.stats() if stats['location'] != 'unloaded']
+
+	# models are loaded in the worker processes when there is a pool
+	if pool is None:
+		metrics.sampled('sd_model_bytes', 'Parameter memory of loaded models, on the device or offloaded to CPU memory.', modelBytes)
+
+	if pool is not None:
+		metrics.sampled('sd_worker_restarts_total', 'Restarts of worker processes.',
+			lambda: [(dict(worker=str(worker['index'])), worker['restarts']) for worker in pool.stats()], type='counter')
+
+
+@app.route('/random-sentence', methods=['GET'])
+def randomSentence ():
+	return flask.Response(models['fill_mask'].get().generate(temperature=TEMPERATURE), mimetype = 'text/plain')
 
 
 @app.route('/random-sentence-v2', methods=['GET'])
 def randomSentenceV2 ():
-	global senGen2
-
 	temperature = float(flask.request.args.get('temperature', 1))
 	begin = flask.request.args.get('begin', '')
 
-	return flask.Response(senGen2.generate(leading_text=begin, temperature=temperature), mimetype='text/plain')
+	return flask.Response(models['textgen'].get().generate(leading_text=begin, temperature=temperature), mimetype='text/plain')
 
 
-def main (argv):
-	global pipe, senGen2, senGen, rand_generator
-	pipe = StableDiffusionPipeline.from_pretrained(DIFFUSER_MODEL_PATH, use_auth_token=HF_TOKEN, torch_dtype=torch.float32)
+@app.route('/healthz', methods=['GET'])
+def healthz ():
+	# the process is up and serving requests
+	return jsonResponse({'status': 'ok'})
 
-	device = torch.device(f'{DEVICE}:{TEXT_DEVICE_INDEX}') if DEVICE else None
-	senGen = SentenceGenerator(templates_path='corpus/templates.txt', reserved_path='corpus/reserved.txt', device=device)
-	senGen2 = SentenceGeneratorV2(TEXTGEN_MODEL_PATH, pipe.tokenizer, device=device)
 
+@app.route('/readyz', methods=['GET'])
+def readyz ():
+	# ready once the components listed in WARMUP are loaded and warmed up, the others load on first use
+	ready = warmup['status'] == 'done'
+
+	return jsonResponse({
+		'ready': ready,
+		'warmup': warmup,
+		'models': {name: model.describe() for name, model in models.items()},
+	}, status=200 if ready else 503)
+
+
+def warmUp (names):
+	warmup['status'] = 'running'
+	for name in names:
+		try:
+			models[name].get()
+
+			# a small generation through the job queue, so the first client does not pay for kernel and allocator warm-up,
+			# in compiled mode one per resolution bucket, to trace their graphs
+			if name == 'diffusion':
+				sizes = RESOLUTION_BUCKETS if COMPILE and RESOLUTION_BUCKETS else [(WARMUP_PAINT['width'], WARMUP_PAINT['height'])]
+				for width, height in sizes:
+					job = jobQueue.submit('paint', dict(WARMUP_PAINT, width=width, height=height, seed=0, model=MODEL_NAME, guidance_window=GUIDANCE_WINDOW,
+						feature_reuse=FEATURE_REUSE_INTERVAL, scheduler=SCHEDULER),
+						key=(MODEL_NAME, width, height, WARMUP_PAINT['n_steps'], GUIDANCE_WINDOW, FEATURE_REUSE_INTERVAL, SCHEDULER),
+						size=WARMUP_PAINT['multi'], total_steps=WARMUP_PAINT['n_steps'])
+					job.wait()
+		except Exception as error:
+			print(f'warm-up of {name} failed:', error)
+			warmup.update(status='failed', error=f'{name}: {type(error).__name__}: {error}')
+			return
+
+		print(f'{name} is ready.')
+
+	warmup['status'] = 'done'
+
+
+def setup ():
+	# creates the job queue and the lazily loaded models, loading starts in the background for those listed in WARMUP
+	global rand_generator, jobQueue, resultCache, admission
+
+	device = torch.device(f'{DEVICE}:{TEXT_DEVICE_INDEX}') if DEVICE else None
 	rand_generator = torch.Generator(device)
 
-	if DEVICE:
-		pipe.to(DEVICE)
+	runner_options = dict(decode_batch_size=DECODE_BATCH_SIZE, preview_steps=PREVIEW_STEPS, step_batch_size=STEP_BATCH_SIZE, synchronize_stages=METRICS_SYNC,
+		vae_tiling_pixels=VAE_TILING_PIXELS, vae_tile_size=VAE_TILE_SIZE, compiled=COMPILE, compile_cache_size=COMPILE_CACHE_SIZE)
+	registry_options = dict(default=MODEL_NAME, dtype=DTYPE, memory_budget=MODEL_MEMORY_BUDGET * 2**20, eviction=MODEL_EVICTION, sequential_offload=SEQUENTIAL_OFFLOAD,
+		runner_options=runner_options)
+	loader = functools.partial(loadPipeline, token=HF_TOKEN)
+	if WORKERS > 0:
+		# each worker process loads its own pipelines, devices are assigned in turn
+		devices = [WORKER_DEVICES[i % len(WORKER_DEVICES)] for i in range(WORKERS)]
+		pool = WorkerPool(DIFFUSER_MODELS, loader, devices, threads=WORKER_THREADS, embedding_cache_size=EMBEDDING_CACHE_SIZE,
+			registry_options=registry_options, stage_observer=observeStage, switch_observer=observeModelSwitch)
+
+		# workers start loading at once, the default model is loaded when one of them is ready
+		def loadDiffusion ():
+			pool.info()
+			return pool
+
+		runners = len(pool)
+	else:
+		StableDiffusionPipeline.embedding_cache.resize(EMBEDDING_CACHE_SIZE)
+
+		def loadDiffusion ():
+			registry = ModelRegistry(DIFFUSER_MODELS, loader, device=DEVICE, stage_observer=observeStage, switch_observer=observeModelSwitch, **registry_options)
+			registry.info()
+			return registry
+
+		runners = 1
+		pool = None
+
+	models['diffusion'] = LazyModel('diffusion', loadDiffusion)
+	models['fill_mask'] = LazyModel('fill_mask', lambda: SentenceGenerator(templates_path='corpus/templates.txt', reserved_path='corpus/reserved.txt',
+		device=device, model_path=FILL_MASK_MODEL_PATH))
+	models['textgen'] = LazyModel('textgen', lambda: SentenceGeneratorV2(TEXTGEN_MODEL_PATH, loadTokenizer(DIFFUSER_MODEL_PATH, token=HF_TOKEN), device=device))
+
+	resultCache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_SIZE * 2**20) if RESULT_CACHE_SIZE > 0 else None
+
+	# bulk (`img_only`) traffic is limited apart, so it cannot crowd out interactive clients
+	budgets = dict(interactive=ADMISSION_BUDGET, bulk=ADMISSION_BULK_BUDGET)
+	admission = AdmissionControl(budgets) if any(budgets.values()) else None
+
+	def runBatch (kind, items):
+		batchImages.observe(sum(item.size for item in items), kind=kind)
+		return models['diffusion'].get()(kind, items)
+
+	# pipeline calls go through the job queue's dispatch threads, so request threads only parse and encode.
+	# Up to RUNNING_BATCHES batches per runner are in flight at once, their denoising steps are merged by the step engine.
+	jobQueue = JobQueue(runBatch, window=BATCH_WINDOW_MS / 1000, max_batch_size=BATCH_SIZE, retention=JOB_RETENTION,
+		threads=runners * RUNNING_BATCHES, postprocess=encodeJobResult, postprocess_threads=ENCODE_THREADS)
+
+	registerMetrics(pool)
+
+	unknown = [name for name in WARMUP if name not in models]
+	if unknown:
+		raise ValueError(f'unknown WARMUP components: {", ".join(unknown)}, should be of {", ".join(models)}.')
+
+	warmup['components'] = WARMUP
+	threading.Thread(target=warmUp, args=(WARMUP,), daemon=True).start()
+
+
+def main (argv):
+	setup()
 
 	try:
-		app.run(port=HTTP_PORT, host=HTTP_HOST, threaded=False, ssl_context=SSL_CONTEXT)
+		app.run(port=HTTP_PORT, host=HTTP_HOST, threaded=True, ssl_context=SSL_CONTEXT)
 	except:
 		print('server interrupted:', sys.exc_info())
 
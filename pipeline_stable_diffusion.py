@@ -1,9 +1,10 @@
 
+import copy
+import contextlib
 import inspect
+import time
 #import warnings
-from typing import List, Optional, Union, Callable
-import base64
-import struct
+from typing import List, Optional, Tuple, Union, Callable
 import PIL.Image
 import logging
 from packaging import version
@@ -16,6 +17,7 @@ from transformers import CLIPFeatureExtractor, CLIPTextModel, CLIPTokenizer
 from diffusers.utils import deprecate
 from diffusers.configuration_utils import FrozenDict
 from diffusers.models import AutoencoderKL, UNet2DConditionModel
+from diffusers.models.vae import DiagonalGaussianDistribution
 from diffusers.pipeline_utils import DiffusionPipeline
 from diffusers.schedulers import (
 	DDIMScheduler,
@@ -28,10 +30,34 @@ from diffusers.schedulers import (
 from diffusers.pipelines.stable_diffusion import StableDiffusionPipelineOutput
 from diffusers.pipelines.stable_diffusion.safety_checker import StableDiffusionSafetyChecker
 
+from sdUtils import EmbeddingCache
+from sdUtils import tiledVae
+from sdUtils import featureCache
+from sdUtils import SequentialOffload
+from sdUtils.compiledModules import ShapeCompiled, UNetSample, VaeDecodeSample
+
 
 
 LATENTS_SCALING = 0.18215
 
+# schedulers selectable per request, built from the config of the pipeline's scheduler
+SCHEDULERS = {
+	"ddim": DDIMScheduler,
+	"pndm": PNDMScheduler,
+	"lms": LMSDiscreteScheduler,
+	"euler": EulerDiscreteScheduler,
+	"euler_ancestral": EulerAncestralDiscreteScheduler,
+	"dpm_multistep": DPMSolverMultistepScheduler,
+}
+
+# approximate contribution of each latent channel to RGB, for previews without running the VAE decoder
+LATENTS_RGB_FACTORS = [
+	[0.3512, 0.2297, 0.3227],
+	[0.3250, 0.4974, 0.2350],
+	[-0.2829, 0.1762, 0.2721],
+	[-0.2120, -0.2616, -0.7177],
+]
+
 
 def preprocess (image):
 	w, h = image.size
@@ -75,9 +101,131 @@ def prepare_mask_and_masked_image(image, mask):
 	return mask, masked_image
 
 
-def encodeFloat32 (tensor):
-	tensor = tensor.flatten()
-	return base64.b64encode(struct.pack('f' * tensor.shape[0], *tensor)).decode('ascii')
+def encodeLatents (latents, dtype=torch.float32):
+	# one contiguous host buffer for the whole tensor, in native byte order
+	return latents.detach().to(device="cpu", dtype=dtype).contiguous().numpy().tobytes()
+
+
+class DenoisingCancelled (Exception):
+	pass
+
+
+class DenoisingRequest:
+	r"""
+	State of one batch of latents in the denoising loop. Each request has its own scheduler, timesteps, position and text
+	embeddings, so requests at different steps of different schedules can share UNet calls, see
+	`StableDiffusionPipeline.denoise_step`.
+
+	`text_embeddings` hold the unconditional rows before the text rows when using classifier free guidance, and
+	`conditioning` holds extra UNet input channels (e.g. mask and masked image latents of inpainting), with the same rows
+	as `text_embeddings`.
+
+	`guidance_scale` is a scale or a sequence of scales, one per timestep. Guidance applies to the steps in
+	`guidance_window`, a `(start, end)` range of fractions of `timesteps`, all of them if `None`. Other steps, or steps of
+	scale 1, run the UNet on the text rows only, half the rows of a guided step.
+
+	With `feature_reuse_interval` N > 1, the deep UNet blocks run every N steps only, the steps between reuse their
+	features, see `featureCache.featureReuseForward`.
+
+	`cancelled`, if provided, is polled between steps, the request stops once it returns `True`.
+	"""
+
+	def __init__ (
+		self,
+		latents,
+		text_embeddings,
+		scheduler,
+		timesteps,
+		guidance_scale=7.5,
+		extra_step_kwargs=None,
+		conditioning=None,
+		callback=None,
+		callback_steps=1,
+		cancelled=None,
+		guidance_window=None,
+		feature_reuse_interval=1,
+	):
+		self.latents = latents
+		self.text_embeddings = text_embeddings
+		self.scheduler = scheduler
+		self.timesteps = timesteps
+		self.guidance_scale = guidance_scale
+		self.guidance_window = guidance_window
+		self.do_classifier_free_guidance = self.uses_guidance(guidance_scale)
+		self.extra_step_kwargs = extra_step_kwargs or {}
+		self.conditioning = conditioning
+		self.callback = callback
+		self.callback_steps = callback_steps
+		self.cancelled = cancelled
+		self.feature_reuse_interval = feature_reuse_interval or 1
+
+		self.step_index = 0
+		# deep UNet features of the last full step, with its index and whether it was guided
+		self.features = None
+		self.features_step = None
+		self.features_guided = None
+
+
+	@property
+	def done (self):
+		return self.step_index >= len(self.timesteps)
+
+
+	@property
+	def is_cancelled (self):
+		return self.cancelled is not None and bool(self.cancelled())
+
+
+	@property
+	def timestep (self):
+		return self.timesteps[self.step_index]
+
+
+	@staticmethod
+	def uses_guidance (guidance_scale):
+		# whether text embeddings need the unconditional rows
+		scales = guidance_scale if isinstance(guidance_scale, (list, tuple)) else [guidance_scale]
+		return any(scale > 1.0 for scale in scales)
+
+
+	@property
+	def step_guidance_scale (self):
+		# guidance scale of the current step, 1 outside of the guidance window
+		if self.guidance_window is not None:
+			start, end = self.guidance_window
+			if not start <= self.step_index / len(self.timesteps) < end:
+				return 1.0
+
+		if isinstance(self.guidance_scale, (list, tuple)):
+			return self.guidance_scale[min(self.step_index, len(self.guidance_scale) - 1)]
+
+		return self.guidance_scale
+
+
+	@property
+	def guided (self):
+		# whether the current step runs the unconditional branch
+		return self.do_classifier_free_guidance and self.step_guidance_scale > 1.0
+
+
+	def reusable_features (self, guided):
+		# deep features for the rows of the current step, `None` when it runs the full UNet
+		if self.features is None or self.step_index - self.features_step >= self.feature_reuse_interval:
+			return None
+		if guided == self.features_guided:
+			return self.features
+		# the text rows of a guided step serve an unguided one, not the other way round
+		if self.features_guided:
+			return self.features.chunk(2)[1]
+
+		return None
+
+
+	@property
+	def shape_key (self):
+		# requests can share a UNet call when their model inputs and text embeddings have the same shapes
+		channels = self.latents.shape[1] + (self.conditioning.shape[1] if self.conditioning is not None else 0)
+		return (channels, *self.latents.shape[2:], *self.text_embeddings.shape[1:])
 
 
 class StableDiffusionPipeline (DiffusionPipeline):
@@ -108,6 +256,29 @@ class StableDiffusionPipeline (DiffusionPipeline):
 			Model that extracts features from generated images to be used as inputs for the `safety_checker`.
 	"""
 
+	# shared by all pipeline instances, entries are keyed by text encoder
+	embedding_cache = EmbeddingCache()
+
+	# called as `stage_observer(stage, seconds, batch_size)` after each timed stage, see `stage_timer`
+	stage_observer = None
+	# wait for queued device work around timed stages, so their times are not just launch times
+	synchronize_stages = False
+	# images of more pixels than `vae_tiling_pixels` go through the VAE in tiles of `vae_tile_size` pixels overlapping by
+	# `vae_tile_overlap`, bounding peak memory by the tile size. `None` for no tiling
+	vae_tiling_pixels = None
+	vae_tile_size = 512
+	vae_tile_overlap = 64
+	# a `SequentialOffload` that puts models on the execution device only for their phase, see `enable_sequential_offload`
+	offloader = None
+	# model calls run under autocast to this dtype, e.g. bfloat16 on CPU with float32 weights. Their outputs are cast back
+	# to the weight dtype, so latents and scheduler math keep it. `None` for no autocast
+	autocast_dtype = None
+	# `ShapeCompiled` UNet and VAE decoder, see `enable_compiled_modules`
+	compiled_unet = None
+	compiled_vae_decoder = None
+	# down and up block levels run at every step of requests reusing deep UNet features, see `DenoisingRequest`
+	feature_reuse_depth = 1
+
 	def __init__ (
 		self,
 		vae: AutoencoderKL,
@@ -217,13 +388,83 @@ class StableDiffusionPipeline (DiffusionPipeline):
 		self.enable_attention_slicing(None)
 
 
+	def enable_sequential_offload (self, device=None, offloader=None):
+		r"""
+		Keep models in CPU memory and move each one to `device` only while its phase runs: the text encoder for prompts,
+		the UNet for denoising and the VAE for encoding and decoding. This bounds accelerator memory by the largest model,
+		at the cost of transfers whenever the phase changes.
+
+		Args:
+			device (`str` or `torch.device`, *optional*):
+				The execution device, unless `offloader` is provided.
+			offloader (`SequentialOffload`, *optional*):
+				An offloader shared with other pipelines, e.g. ones sharing models with this one.
+		"""
+		offloader = offloader or SequentialOffload(device)
+		for name in self.config.keys():
+			module = getattr(self, name, None)
+			if isinstance(module, torch.nn.Module):
+				offloader.register(module)
+
+		self.offloader = offloader
+
+
+	def enable_compiled_modules (self, cache_size=16):
+		r"""
+		Run the UNet and the VAE decoder through traced graphs, one per input shapes and dtype, so one per resolution and
+		batch size. Tracing takes a while on the first call of each shape, so request sizes should come from a small set.
+
+		Compiled modules are bypassed under autocast and in sequential offload mode, and traced graphs are dropped by
+		`clear_compiled_modules`, which must be called after moving the pipeline to another device.
+
+		Args:
+			cache_size (`int`, *optional*, defaults to 16):
+				The number of graphs kept for each module, least recently used ones are dropped.
+		"""
+		self.compiled_unet = ShapeCompiled(UNetSample(self.unet), cache_size=cache_size,
+			timer=lambda: self.stage_timer("unet_compile"))
+		self.compiled_vae_decoder = ShapeCompiled(VaeDecodeSample(self.vae), cache_size=cache_size,
+			timer=lambda: self.stage_timer("vae_decode_compile"))
+
+
+	def clear_compiled_modules (self):
+		for compiled in (self.compiled_unet, self.compiled_vae_decoder):
+			if compiled is not None:
+				compiled.clear()
+
+
+	def compiled (self, compiled):
+		# `compiled` if it applies, `None` to run the module eagerly
+		if compiled is None or self.offloader is not None or self.autocast_dtype is not None:
+			return None
+
+		return compiled
+
+
+	def autocast (self):
+		if self.autocast_dtype is None:
+			return contextlib.nullcontext()
+
+		return torch.autocast(device_type=self._execution_device.type, dtype=self.autocast_dtype)
+
+
+	def on_device (self, module):
+		# puts `module` on the execution device for the enclosed block, in sequential offload mode
+		if self.offloader is None:
+			return contextlib.nullcontext()
+
+		return self.offloader.use(module)
+
+
 	@property
 	def _execution_device (self):
 		r"""
 		Returns the device on which the pipeline's models will be executed. After calling
-		`pipeline.enable_sequential_cpu_offload()` the execution device can only be inferred from Accelerate's module
-		hooks.
+		`pipeline.enable_sequential_offload()` models are on CPU between their phases, the execution device is the
+		offloader's. With Accelerate's module hooks, it can only be inferred from the hooks.
 		"""
+		if self.offloader is not None:
+			return self.offloader.device
 		if self.device != torch.device("meta") or not hasattr(self.unet, "_hf_hook"):
 			return self.device
 		for module in self.unet.modules():
@@ -236,7 +477,97 @@ class StableDiffusionPipeline (DiffusionPipeline):
 		return self.device
 
 
-	def _encode_prompt (self, prompt, device, num_images_per_prompt, do_classifier_free_guidance, negative_prompt):
+	@contextlib.contextmanager
+	def stage_timer (self, stage, batch_size=1):
+		r"""
+		Times the enclosed block as `stage` and reports it to `stage_observer`, if one is set.
+		"""
+		if self.stage_observer is None:
+			yield
+			return
+
+		device = self._execution_device
+		synchronize = self.synchronize_stages and device.type == "cuda"
+		if synchronize:
+			torch.cuda.synchronize(device)
+
+		start = time.perf_counter()
+		yield
+		if synchronize:
+			torch.cuda.synchronize(device)
+
+		self.stage_observer(stage, time.perf_counter() - start, batch_size)
+
+
+	@property
+	def _text_encoder_key (self):
+		# identifies the text encoder in embedding cache keys, pipelines sharing a text encoder share entries. Entries
+		# must be cleared when the encoder is dropped, before its id can be reused, see `ModelRegistry.evict`
+		return id(self.text_encoder)
+
+
+	def _encode_texts (self, texts, device, truncation=True):
+		r"""
+		Encodes a list of texts into text encoder hidden states of shape `(len(texts), seq_len, dim)`.
+
+		Embeddings are looked up in `embedding_cache` first, only missing texts go through the tokenizer and text encoder.
+
+		Args:
+			texts (`List[str]`):
+				texts to be encoded
+			device: (`torch.device`):
+				torch device
+			truncation (`bool`):
+				when `True`, overlong texts are truncated the way the tokenizer does, keeping the end-of-text token.
+				Otherwise token ids beyond `model_max_length` are cut off.
+		"""
+		max_length = self.tokenizer.model_max_length
+		keys = [(self._text_encoder_key, text, max_length, truncation) for text in texts]
+		embeddings = [self.embedding_cache.get(key) for key in keys]
+
+		missing = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+		if missing:
+			with self.stage_timer("tokenize", len(missing)):
+				text_inputs = self.tokenizer(missing, padding="max_length", max_length=max_length)
+
+				input_ids, attention_mask = [], []
+				for ids, mask in zip(text_inputs.input_ids, text_inputs.attention_mask):
+					if len(ids) > max_length:
+						# tokenizer truncation keeps the end-of-text token, while cutting off does not
+						removed_ids = ids[max_length - 1 : -1] if truncation else ids[max_length:]
+						ids = ids[: max_length - 1] + ids[-1:] if truncation else ids[:max_length]
+						logging.warning(
+							"The following part of your input was truncated because CLIP can only handle sequences up to"
+							f" {max_length} tokens: {self.tokenizer.decode(removed_ids)}"
+						)
+
+					input_ids.append(ids)
+					attention_mask.append(mask[:max_length])
+
+				text_input_ids = torch.tensor(input_ids)
+
+			if hasattr(self.text_encoder.config, "use_attention_mask") and self.text_encoder.config.use_attention_mask:
+				attention_mask = torch.tensor(attention_mask).to(device)
+			else:
+				attention_mask = None
+
+			with self.on_device(self.text_encoder), self.autocast(), self.stage_timer("text_encoder", len(missing)):
+				encoded = self.text_encoder(
+					text_input_ids.to(device),
+					attention_mask=attention_mask,
+				)[0].to(self.text_encoder.dtype)
+
+			# clone rows, so a cached entry does not hold the whole batch alive
+			encoded = {text: embedding.clone() for text, embedding in zip(missing, encoded)}
+			for text, embedding in encoded.items():
+				self.embedding_cache.put((self._text_encoder_key, text, max_length, truncation), embedding)
+
+			embeddings = [encoded[text] if embedding is None else embedding for text, embedding in zip(texts, embeddings)]
+
+		return torch.stack(embeddings).to(device)
+
+
+	def _encode_prompt (self, prompt, device, num_images_per_prompt, do_classifier_free_guidance, negative_prompt, truncation=True):
 		r"""
 		Encodes the prompt into text encoder hidden states.
 
@@ -252,36 +583,12 @@ class StableDiffusionPipeline (DiffusionPipeline):
 			negative_prompt (`str` or `List[str]`):
 				The prompt or prompts not to guide the image generation. Ignored when not using guidance (i.e., ignored
 				if `guidance_scale` is less than `1`).
+			truncation (`bool`):
+				of the prompt, see `_encode_texts`. Negative prompts are always truncated
 		"""
 		batch_size = len(prompt) if isinstance(prompt, list) else 1
 
-		text_inputs = self.tokenizer(
-			prompt,
-			padding="max_length",
-			max_length=self.tokenizer.model_max_length,
-			truncation=True,
-			return_tensors="pt",
-		)
-		text_input_ids = text_inputs.input_ids
-		untruncated_ids = self.tokenizer(prompt, padding="max_length", return_tensors="pt").input_ids
-
-		if not torch.equal(text_input_ids, untruncated_ids):
-			removed_text = self.tokenizer.batch_decode(untruncated_ids[:, self.tokenizer.model_max_length - 1 : -1])
-			logging.warning(
-				"The following part of your input was truncated because CLIP can only handle sequences up to"
-				f" {self.tokenizer.model_max_length} tokens: {removed_text}"
-			)
-
-		if hasattr(self.text_encoder.config, "use_attention_mask") and self.text_encoder.config.use_attention_mask:
-			attention_mask = text_inputs.attention_mask.to(device)
-		else:
-			attention_mask = None
-
-		text_embeddings = self.text_encoder(
-			text_input_ids.to(device),
-			attention_mask=attention_mask,
-		)
-		text_embeddings = text_embeddings[0]
+		text_embeddings = self._encode_texts(prompt if isinstance(prompt, list) else [prompt], device, truncation=truncation)
 
 		# duplicate text embeddings for each generation per prompt, using mps friendly method
 		bs_embed, seq_len, _ = text_embeddings.shape
@@ -309,25 +616,7 @@ class StableDiffusionPipeline (DiffusionPipeline):
 			else:
 				uncond_tokens = negative_prompt
 
-			max_length = text_input_ids.shape[-1]
-			uncond_input = self.tokenizer(
-				uncond_tokens,
-				padding="max_length",
-				max_length=max_length,
-				truncation=True,
-				return_tensors="pt",
-			)
-
-			if hasattr(self.text_encoder.config, "use_attention_mask") and self.text_encoder.config.use_attention_mask:
-				attention_mask = uncond_input.attention_mask.to(device)
-			else:
-				attention_mask = None
-
-			uncond_embeddings = self.text_encoder(
-				uncond_input.input_ids.to(device),
-				attention_mask=attention_mask,
-			)
-			uncond_embeddings = uncond_embeddings[0]
+			uncond_embeddings = self._encode_texts(uncond_tokens, device, truncation=True)
 
 			# duplicate unconditional embeddings for each generation per prompt, using mps friendly method
 			seq_len = uncond_embeddings.shape[1]
@@ -342,28 +631,87 @@ class StableDiffusionPipeline (DiffusionPipeline):
 		return text_embeddings
 
 
+	def vae_tiled (self, height, width):
+		return bool(self.vae_tiling_pixels) and height * width > self.vae_tiling_pixels
+
+
+	def vae_encode (self, images):
+		# returns the latent distribution of `images`, tile by tile for large images
+		with self.on_device(self.vae), self.autocast():
+			if self.vae_tiled(*images.shape[-2:]):
+				latent_dist = tiledVae.tiledEncode(self.vae, images, tile_size=self.vae_tile_size, overlap=self.vae_tile_overlap)
+			else:
+				latent_dist = self.vae.encode(images).latent_dist
+
+		if latent_dist.parameters.dtype != self.vae.dtype:
+			latent_dist = DiagonalGaussianDistribution(latent_dist.parameters.to(self.vae.dtype))
+
+		return latent_dist
+
+
+	def vae_decode (self, latents):
+		with self.on_device(self.vae), self.autocast():
+			if self.vae_tiled(latents.shape[-2] * self.vae_scale_factor, latents.shape[-1] * self.vae_scale_factor):
+				return tiledVae.tiledDecode(self.vae, latents, tile_size=self.vae_tile_size // self.vae_scale_factor,
+					overlap=self.vae_tile_overlap // self.vae_scale_factor)
+
+			compiled = self.compiled(self.compiled_vae_decoder)
+			if compiled is not None:
+				return compiled(latents)
+
+			return self.vae.decode(latents).sample
+
+
 	def decode_latents(self, latents):
 		latents = 1 / 0.18215 * latents
-		image = self.vae.decode(latents).sample
-		image = (image / 2 + 0.5).clamp(0, 1)
-		# we always cast to float32 as this does not cause significant overhead and is compatible with bfloa16
-		image = image.cpu().permute(0, 2, 3, 1).float().numpy()
+		with self.stage_timer("vae_decode", latents.shape[0]):
+			image = self.vae_decode(latents)
+		# we always cast to float32 as this does not cause significant overhead and is compatible with bfloa16,
+		# before scaling, so that image conversion is in float32 whatever the model dtype
+		image = (image.float() / 2 + 0.5).clamp(0, 1)
+		image = image.cpu().permute(0, 2, 3, 1).numpy()
 		return image
 
 
-	def prepare_extra_step_kwargs(self, generator, eta):
+	def preview_latents (self, latents):
+		r"""
+		Project `latents` to RGB by a fixed linear map of the latent channels. The result is at latent resolution and far
+		cheaper than `decode_latents`, intended for progress previews during denoising.
+		"""
+		factors = torch.tensor(LATENTS_RGB_FACTORS, dtype=latents.dtype, device=latents.device)
+		image = torch.einsum("bchw,cr->bhwr", latents[:, : factors.shape[0]], factors)
+		image = ((image + 1) / 2).clamp(0, 1)
+
+		return self.numpy_to_pil(image.cpu().float().numpy())
+
+
+	def request_scheduler (self, name=None):
+		r"""
+		Returns a scheduler owned by one request: a copy of the pipeline's scheduler, or the scheduler of `name` in
+		`SCHEDULERS` with the same config.
+		"""
+		if name is None:
+			return copy.deepcopy(self.scheduler)
+		if name not in SCHEDULERS:
+			raise ValueError(f"Unknown scheduler: {name}, should be one of {', '.join(SCHEDULERS)}.")
+
+		return SCHEDULERS[name].from_config(self.scheduler.config)
+
+
+	def prepare_extra_step_kwargs(self, generator, eta, scheduler=None):
 		# prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
 		# eta (η) is only used with the DDIMScheduler, it will be ignored for other schedulers.
 		# eta corresponds to η in DDIM paper: https://arxiv.org/abs/2010.02502
 		# and should be between [0, 1]
+		scheduler = scheduler or self.scheduler
 
-		accepts_eta = "eta" in set(inspect.signature(self.scheduler.step).parameters.keys())
+		accepts_eta = "eta" in set(inspect.signature(scheduler.step).parameters.keys())
 		extra_step_kwargs = {}
 		if accepts_eta:
 			extra_step_kwargs["eta"] = eta
 
 		# check if the scheduler accepts generator
-		accepts_generator = "generator" in set(inspect.signature(self.scheduler.step).parameters.keys())
+		accepts_generator = "generator" in set(inspect.signature(scheduler.step).parameters.keys())
 		if accepts_generator:
 			extra_step_kwargs["generator"] = generator
 		return extra_step_kwargs
@@ -385,24 +733,277 @@ class StableDiffusionPipeline (DiffusionPipeline):
 			)
 
 
-	def prepare_latents(self, batch_size, num_channels_latents, height, width, dtype, device, generator, latents=None):
+	def prepare_latents(self, batch_size, num_channels_latents, height, width, dtype, device, generator, latents=None, scheduler=None):
 		shape = (batch_size, num_channels_latents, height // self.vae_scale_factor, width // self.vae_scale_factor)
 		if latents is None:
-			if device.type == "mps":
-				# randn does not work reproducibly on mps
-				latents = torch.randn(shape, generator=generator, device="cpu", dtype=dtype).to(device)
-			else:
-				latents = torch.randn(shape, generator=generator, device=device, dtype=dtype)
+			latents = self.randn_rows(shape, generator, dtype=dtype)
 		else:
 			if latents.shape != shape:
 				raise ValueError(f"Unexpected latents shape, got {latents.shape}, expected {shape}")
 			latents = latents.to(device)
 
 		# scale the initial noise by the standard deviation required by the scheduler
-		latents = latents * self.scheduler.init_noise_sigma
+		latents = latents * (scheduler or self.scheduler).init_noise_sigma
 		return latents
 
 
+	def sample_noise (self, batch_size, height, width, generator=None, dtype=None):
+		r"""
+		Sample unscaled initial latents the same way as `prepare_latents`, so that noise drawn per request with its own
+		generator can be concatenated and passed to `generate` as one batch.
+		"""
+		shape = (batch_size, self.unet.in_channels, height // self.vae_scale_factor, width // self.vae_scale_factor)
+
+		return self.randn_rows(shape, generator, dtype=dtype or self.text_encoder.dtype)
+
+
+	def randn_rows (self, shape, generator=None, dtype=None):
+		# standard normal noise on the execution device, one row per generator if `generator` is a list
+		device = self._execution_device
+		# randn does not work reproducibly on mps
+		sample_device = "cpu" if device.type == "mps" else device
+
+		if isinstance(generator, list):
+			noise = torch.cat([torch.randn((1, *shape[1:]), generator=g, device=sample_device, dtype=dtype) for g in generator])
+		else:
+			noise = torch.randn(shape, generator=generator, device=sample_device, dtype=dtype)
+
+		return noise.to(device)
+
+
+	@torch.no_grad()
+	def prepare_generate (
+		self,
+		prompt,
+		height=None,
+		width=None,
+		num_inference_steps=50,
+		guidance_scale=7.5,
+		negative_prompt=None,
+		num_images_per_prompt=1,
+		eta=0.0,
+		generator=None,
+		latents=None,
+		callback=None,
+		callback_steps=1,
+		cancelled=None,
+		guidance_window=None,
+		feature_reuse_interval=1,
+		scheduler=None,
+	):
+		r"""
+		Encodes the prompt and prepares the initial latents of `generate`, see its arguments. Returns a
+		`DenoisingRequest`.
+		"""
+		# 0. Default height and width to unet
+		height = height or self.unet.config.sample_size * self.vae_scale_factor
+		width = width or self.unet.config.sample_size * self.vae_scale_factor
+
+		# 1. Check inputs. Raise error if not correct
+		self.check_inputs(prompt, height, width, callback_steps)
+
+		# 2. Define call parameters
+		batch_size = 1 if isinstance(prompt, str) else len(prompt)
+		device = self._execution_device
+		if isinstance(generator, list) and len(generator) != batch_size * num_images_per_prompt:
+			raise ValueError(f"Got {len(generator)} generators for a batch of {batch_size * num_images_per_prompt}, there should be one per image.")
+		# here `guidance_scale` is defined analog to the guidance weight `w` of equation (2)
+		# of the Imagen paper: https://arxiv.org/pdf/2205.11487.pdf . `guidance_scale = 1`
+		# corresponds to doing no classifier free guidance.
+		do_classifier_free_guidance = DenoisingRequest.uses_guidance(guidance_scale)
+
+		# 3. Encode input prompt
+		text_embeddings = self._encode_prompt(
+			prompt, device, num_images_per_prompt, do_classifier_free_guidance, negative_prompt
+		)
+
+		# 4. Prepare timesteps, on a scheduler owned by the request
+		scheduler = self.request_scheduler(scheduler)
+		scheduler.set_timesteps(num_inference_steps, device=device)
+
+		# 5. Prepare latent variables
+		num_channels_latents = self.unet.in_channels
+		latents = self.prepare_latents(
+			batch_size * num_images_per_prompt,
+			num_channels_latents,
+			height,
+			width,
+			text_embeddings.dtype,
+			device,
+			generator,
+			latents,
+			scheduler=scheduler,
+		)
+
+		# 6. Prepare extra step kwargs. TODO: Logic should ideally just be moved out of the pipeline
+		extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta, scheduler=scheduler)
+
+		return DenoisingRequest(
+			latents,
+			text_embeddings,
+			scheduler,
+			scheduler.timesteps,
+			guidance_scale=guidance_scale,
+			extra_step_kwargs=extra_step_kwargs,
+			callback=callback,
+			callback_steps=callback_steps,
+			cancelled=cancelled,
+			guidance_window=guidance_window,
+			feature_reuse_interval=feature_reuse_interval,
+		)
+
+
+	@torch.no_grad()
+	def denoise_step (self, requests: List[DenoisingRequest]):
+		r"""
+		Runs one denoising step of each of `requests` in a single UNet call. The requests must have the same `shape_key`,
+		but each one advances on its own timestep and scheduler.
+		"""
+		device = self._execution_device
+
+		model_inputs, embeddings, guided_steps = [], [], []
+		for request in requests:
+			t = request.timestep
+			guided = request.guided
+			guided_steps.append(guided)
+
+			# expand the latents if we are doing classifier free guidance
+			latent_model_input = torch.cat([request.latents] * 2) if guided else request.latents
+			latent_model_input = request.scheduler.scale_model_input(latent_model_input, t)
+
+			# steps out of the guidance window take the text rows only, the second half
+			text_embeddings, conditioning = request.text_embeddings, request.conditioning
+			if request.do_classifier_free_guidance and not guided:
+				text_embeddings = text_embeddings.chunk(2)[1]
+				conditioning = conditioning.chunk(2)[1] if conditioning is not None else None
+
+			# concat extra channels, e.g. mask and masked_image_latents, after scaling the latents
+			if conditioning is not None:
+				latent_model_input = torch.cat([latent_model_input, conditioning], dim=1)
+
+			model_inputs.append(latent_model_input)
+			embeddings.append(text_embeddings)
+
+		# a scalar timestep when all requests are in step, otherwise one per row
+		timesteps = [torch.as_tensor(request.timestep, device=device, dtype=torch.float32) for request in requests]
+		if all(torch.equal(t, timesteps[0]) for t in timesteps[1:]):
+			t = requests[0].timestep
+		else:
+			t = torch.cat([t.expand(model_input.shape[0]) for t, model_input in zip(timesteps, model_inputs)])
+
+		# predict the noise residual
+		text_embeddings = torch.cat(embeddings)
+		model_input = torch.cat(model_inputs)
+		reuse = any(request.feature_reuse_interval > 1 for request in requests)
+		with self.on_device(self.unet), self.autocast(), self.stage_timer("unet", model_input.shape[0]):
+			compiled = self.compiled(self.compiled_unet)
+			if reuse:
+				noise_pred = self.reuse_features_step(requests, model_inputs, guided_steps, model_input, t, text_embeddings)
+			elif compiled is not None:
+				noise_pred = compiled(model_input, torch.as_tensor(t, device=device), text_embeddings)
+			else:
+				noise_pred = self.unet(model_input, t, encoder_hidden_states=text_embeddings).sample.to(model_input.dtype)
+
+		offset = 0
+		for request, model_input in zip(requests, model_inputs):
+			noise = noise_pred[offset : offset + model_input.shape[0]]
+			offset += model_input.shape[0]
+
+			# perform guidance
+			if request.guided:
+				noise_pred_uncond, noise_pred_text = noise.chunk(2)
+				noise = noise_pred_uncond + request.step_guidance_scale * (noise_pred_text - noise_pred_uncond)
+
+			# compute the previous noisy sample x_t -> x_t-1
+			t = request.timestep
+			with self.stage_timer("scheduler_step", request.latents.shape[0]):
+				request.latents = self.scheduler_step(request, noise, t)
+
+			# call the callback, if provided
+			if request.callback is not None and request.step_index % request.callback_steps == 0:
+				request.callback(request.step_index, t, request.latents)
+
+			request.step_index += 1
+
+
+	def scheduler_step (self, request, noise, t):
+		# with a list of generators, rows are stepped in runs sharing a generator, so that the step noise of ancestral
+		# schedulers drawn for a seed does not depend on the other rows of the batch. Schedulers taking a generator
+		# keep no state between rows of a step
+		kwargs = request.extra_step_kwargs
+		generator = kwargs.get("generator")
+		if not isinstance(generator, list):
+			return request.scheduler.step(noise, t, request.latents, **kwargs).prev_sample
+
+		samples = []
+		start = 0
+		for end in range(1, len(generator) + 1):
+			if end == len(generator) or generator[end] is not generator[start]:
+				step_kwargs = dict(kwargs, generator=generator[start])
+				samples.append(request.scheduler.step(noise[start:end], t, request.latents[start:end], **step_kwargs).prev_sample)
+				start = end
+
+		return torch.cat(samples)
+
+
+	def reuse_features_step (self, requests, model_inputs, guided_steps, model_input, t, text_embeddings):
+		# runs the deep blocks on rows of requests due for a full step, and stores their features
+		deep_rows, cached, full_steps = [], [], []
+		offset = 0
+		for request, rows, guided in zip(requests, model_inputs, guided_steps):
+			features = request.reusable_features(guided) if request.feature_reuse_interval > 1 else None
+			if features is None:
+				deep_rows += range(offset, offset + rows.shape[0])
+			else:
+				cached.append(features)
+			full_steps.append(features is None)
+			offset += rows.shape[0]
+
+		noise_pred, features = featureCache.featureReuseForward(self.unet, model_input, t, text_embeddings, deep_rows,
+			cached=torch.cat(cached) if cached else None, depth=self.feature_reuse_depth)
+
+		offset = 0
+		for request, rows, guided, full in zip(requests, model_inputs, guided_steps, full_steps):
+			if full and request.feature_reuse_interval > 1:
+				request.features = features[offset : offset + rows.shape[0]]
+				request.features_step = request.step_index
+				request.features_guided = guided
+			offset += rows.shape[0]
+
+		return noise_pred.to(model_input.dtype)
+
+
+	def denoise (self, request: DenoisingRequest):
+		r"""
+		Runs all remaining steps of `request` on its own.
+		"""
+		for _ in self.progress_bar(range(len(request.timesteps) - request.step_index)):
+			if request.is_cancelled:
+				raise DenoisingCancelled(f"denoising is cancelled at step {request.step_index}.")
+
+			self.denoise_step([request])
+
+
+	@torch.no_grad()
+	def finish_denoising (self, request: DenoisingRequest, output_type="pil", return_latents=False):
+		r"""
+		Decodes the latents of a finished `request`, returns a dict of `images`, the denoised `latents` on CPU if
+		`return_latents`, and `nsfw_content_detected`.
+		"""
+		latents = request.latents
+		image = self.decode_latents(latents.to(self.vae.dtype))
+
+		# run safety checker
+		#image, has_nsfw_concept = self.run_safety_checker(image, device, text_embeddings.dtype)
+		has_nsfw_concept = None
+
+		# convert to PIL
+		if output_type == "pil":
+			image = self.numpy_to_pil(image)
+
+		return dict(images=image, latents=latents.cpu() if return_latents else None, nsfw_content_detected=has_nsfw_concept)
+
+
 	@torch.no_grad()
 	def generate (
 		self,
@@ -410,16 +1011,21 @@ class StableDiffusionPipeline (DiffusionPipeline):
 		height: Optional[int] = None,
 		width: Optional[int] = None,
 		num_inference_steps: Optional[int] = 50,
-		guidance_scale: Optional[float] = 7.5,
+		guidance_scale: Optional[Union[float, List[float]]] = 7.5,
 		negative_prompt: Optional[Union[str, List[str]]] = None,
 		num_images_per_prompt: Optional[int] = 1,
 		eta: Optional[float] = 0.0,
-		generator: Optional[torch.Generator] = None,
+		generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
 		latents: Optional[torch.FloatTensor] = None,
 		output_type: Optional[str] = "pil",
 		return_dict: bool = True,
 		callback: Optional[Callable[[int, int, torch.FloatTensor], None]] = None,
 		callback_steps: Optional[int] = 1,
+		return_latents: bool = False,
+		cancelled: Optional[Callable[[], bool]] = None,
+		guidance_window: Optional[Tuple[float, float]] = None,
+		feature_reuse_interval: Optional[int] = 1,
+		scheduler: Optional[str] = None,
 		**kwargs,
 	):
 		r"""
@@ -435,8 +1041,8 @@ class StableDiffusionPipeline (DiffusionPipeline):
 			num_inference_steps (`int`, *optional*, defaults to 50):
 				The number of denoising steps. More denoising steps usually lead to a higher quality image at the
 				expense of slower inference.
-			guidance_scale (`float`, *optional*, defaults to 7.5):
-				Guidance scale as defined in [Classifier-Free Diffusion Guidance](https://arxiv.org/abs/2207.12598).
+			guidance_scale (`float` or `List[float]`, *optional*, defaults to 7.5):
+				Guidance scale, or one per denoising step, as defined in [Classifier-Free Diffusion Guidance](https://arxiv.org/abs/2207.12598).
 				`guidance_scale` is defined as `w` of equation 2. of [Imagen
 				Paper](https://arxiv.org/pdf/2205.11487.pdf). Guidance scale is enabled by setting `guidance_scale >
 				1`. Higher guidance scale encourages to generate images that are closely linked to the text `prompt`,
@@ -449,9 +1055,10 @@ class StableDiffusionPipeline (DiffusionPipeline):
 			eta (`float`, *optional*, defaults to 0.0):
 				Corresponds to parameter eta (η) in the DDIM paper: https://arxiv.org/abs/2010.02502. Only applies to
 				[`schedulers.DDIMScheduler`], will be ignored for others.
-			generator (`torch.Generator`, *optional*):
+			generator (`torch.Generator` or `List[torch.Generator]`, *optional*):
 				A [torch generator](https://pytorch.org/docs/stable/generated/torch.Generator.html) to make generation
-				deterministic.
+				deterministic, or one per image of the batch, which then does not depend on the other images. A
+				generator may repeat for consecutive images.
 			latents (`torch.FloatTensor`, *optional*):
 				Pre-generated noisy latents, sampled from a Gaussian distribution, to be used as inputs for image
 				generation. Can be used to tweak the same generation with different prompts. If not provided, a latents
@@ -468,6 +1075,19 @@ class StableDiffusionPipeline (DiffusionPipeline):
 			callback_steps (`int`, *optional*, defaults to 1):
 				The frequency at which the `callback` function will be called. If not specified, the callback will be
 				called at every step.
+			return_latents (`bool`, *optional*, defaults to `False`):
+				Whether to return the denoised latents, moved to CPU in one copy, as `latents` of the result.
+			cancelled (`Callable`, *optional*):
+				A function polled between denoising steps, `DenoisingCancelled` is raised once it returns `True`.
+			guidance_window (`Tuple[float, float]`, *optional*):
+				The `(start, end)` fractions of the denoising steps that run classifier free guidance, e.g. `(0, 0.6)`.
+				Other steps run the UNet on the prompt only, at half the cost. All steps are guided if not provided.
+			feature_reuse_interval (`int`, *optional*, defaults to 1):
+				Run the deep UNet blocks every `feature_reuse_interval` steps only, reusing their features in the steps
+				between, for faster denoising at some loss of detail. `1` runs the full UNet at every step.
+			scheduler (`str`, *optional*):
+				The scheduler of this call, one of `SCHEDULERS`, with the config of `pipeline.scheduler`, e.g.
+				`"dpm_multistep"` for good images in 15 to 25 steps. `pipeline.scheduler` if not provided.
 
 		Returns:
 			[`~pipelines.stable_diffusion.StableDiffusionPipelineOutput`] or `tuple`:
@@ -476,124 +1096,193 @@ class StableDiffusionPipeline (DiffusionPipeline):
 			list of `bool`s denoting whether the corresponding generated image likely represents "not-safe-for-work"
 			(nsfw) content, according to the `safety_checker`.
 		"""
-		# 0. Default height and width to unet
-		height = height or self.unet.config.sample_size * self.vae_scale_factor
-		width = width or self.unet.config.sample_size * self.vae_scale_factor
+		request = self.prepare_generate(
+			prompt,
+			height=height,
+			width=width,
+			num_inference_steps=num_inference_steps,
+			guidance_scale=guidance_scale,
+			negative_prompt=negative_prompt,
+			num_images_per_prompt=num_images_per_prompt,
+			eta=eta,
+			generator=generator,
+			latents=latents,
+			callback=callback,
+			callback_steps=callback_steps,
+			cancelled=cancelled,
+			guidance_window=guidance_window,
+			feature_reuse_interval=feature_reuse_interval,
+			scheduler=scheduler,
+		)
+		self.denoise(request)
+		result = self.finish_denoising(request, output_type=output_type, return_latents=return_latents)
 
-		# 1. Check inputs. Raise error if not correct
-		self.check_inputs(prompt, height, width, callback_steps)
+		if not return_dict:
+			return (result["images"], result["nsfw_content_detected"])
 
-		# 2. Define call parameters
-		batch_size = 1 if isinstance(prompt, str) else len(prompt)
-		device = self._execution_device
-		# here `guidance_scale` is defined analog to the guidance weight `w` of equation (2)
-		# of the Imagen paper: https://arxiv.org/pdf/2205.11487.pdf . `guidance_scale = 1`
-		# corresponds to doing no classifier free guidance.
-		do_classifier_free_guidance = guidance_scale > 1.0
+		return result
 
-		# 3. Encode input prompt
-		text_embeddings = self._encode_prompt(
-			prompt, device, num_images_per_prompt, do_classifier_free_guidance, negative_prompt
-		)
 
-		# 4. Prepare timesteps
-		self.scheduler.set_timesteps(num_inference_steps, device=device)
-		timesteps = self.scheduler.timesteps
+	@torch.no_grad()
+	def decode (
+		self,
+		latents: torch.FloatTensor,
+		batch_size: Optional[int] = None,
+		output_type: Optional[str] = "pil",
+		**kwargs,
+	):
+		r"""
+		Decode denoised latents, as returned by `generate` or `convert` with `return_latents`, into images.
 
-		# 5. Prepare latent variables
-		num_channels_latents = self.unet.in_channels
-		latents = self.prepare_latents(
-			batch_size * num_images_per_prompt,
-			num_channels_latents,
-			height,
-			width,
-			text_embeddings.dtype,
-			device,
-			generator,
-			latents,
-		)
+		Args:
+			latents (`torch.FloatTensor`):
+				Latents of shape `(N, C, H, W)`, before the VAE scaling is undone.
+			batch_size (`int`, *optional*):
+				The number of latents to go through `vae.decode` at a time, to bound peak memory. All at once if not
+				provided.
+			output_type (`str`, *optional*, defaults to `"pil"`):
+				The output format of the decoded image. Choose between
+				[PIL](https://pillow.readthedocs.io/en/stable/): `PIL.Image.Image` or `np.array`.
+		"""
+		device = self._execution_device
+		batch_size = batch_size or latents.shape[0]
 
-		# 6. Prepare extra step kwargs. TODO: Logic should ideally just be moved out of the pipeline
-		extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta)
+		image = np.concatenate([
+			self.decode_latents(latents[i : i + batch_size].to(device=device, dtype=self.vae.dtype))
+			for i in range(0, latents.shape[0], batch_size)
+		])
 
-		# 7. Denoising loop
-		for i, t in enumerate(self.progress_bar(timesteps)):
-			# expand the latents if we are doing classifier free guidance
-			latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
-			latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
+		if output_type == "pil":
+			image = self.numpy_to_pil(image)
 
-			# predict the noise residual
-			noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=text_embeddings).sample
+		return dict(images=image)
 
-			# perform guidance
-			if do_classifier_free_guidance:
-				noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-				noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
 
-			# compute the previous noisy sample x_t -> x_t-1
-			latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs).prev_sample
+	@torch.no_grad()
+	def prepare_convert (
+		self,
+		prompt,
+		init_image,
+		strength=0.8,
+		num_inference_steps=50,
+		guidance_scale=7.5,
+		eta=0.0,
+		generator=None,
+		callback=None,
+		callback_steps=1,
+		cancelled=None,
+		guidance_window=None,
+		feature_reuse_interval=1,
+		scheduler=None,
+	):
+		r"""
+		Encodes the prompt and the noised init image of `convert`, see its arguments. Returns a `DenoisingRequest`.
+		"""
+		if not isinstance(prompt, (str, list)):
+			raise ValueError(f"`prompt` has to be of type `str` or `list` but is {type(prompt)}")
 
-			# call the callback, if provided
-			if callback is not None and i % callback_steps == 0:
-				callback(i, t, latents)
+		# one image for all prompts, one prompt for all images, or pairs of them
+		prompts = [prompt] if isinstance(prompt, str) else prompt
+		n_images = init_image.shape[0] if isinstance(init_image, torch.Tensor) else len(init_image) if isinstance(init_image, list) else 1
+		if len(prompts) > 1 and n_images > 1 and len(prompts) != n_images:
+			raise ValueError(f"Got {len(prompts)} prompts for {n_images} images, there should be one prompt or one per image.")
 
-		# 8. Post-processing
-		image = self.decode_latents(latents)
+		batch_size = max(len(prompts), n_images)
+		prompts = prompts * batch_size if len(prompts) == 1 else prompts
 
-		latent_codes = [encodeFloat32(l) for l in latents]
+		if isinstance(generator, list) and len(generator) != batch_size:
+			raise ValueError(f"Got {len(generator)} generators for a batch of {batch_size}, there should be one per image.")
 
-		# 9. Run safety checker
-		#image, has_nsfw_concept = self.run_safety_checker(image, device, text_embeddings.dtype)
-		has_nsfw_concept = None
+		if strength < 0 or strength > 1:
+			raise ValueError(f"The value of strength should in [0.0, 1.0] but is {strength}")
 
-		# 10. Convert to PIL
-		if output_type == "pil":
-			image = self.numpy_to_pil(image)
+		device = self._execution_device
 
-		if not return_dict:
-			return (image, has_nsfw_concept)
+		# set timesteps, on a scheduler owned by the request
+		scheduler = self.request_scheduler(scheduler)
+		scheduler.set_timesteps(num_inference_steps, device=device)
 
-		return dict(images=image, latents=latent_codes, nsfw_content_detected=has_nsfw_concept)
+		if not isinstance(init_image, torch.Tensor):
+			# images of one size, encoded in one batch
+			init_image = torch.cat([preprocess(image) for image in (init_image if isinstance(init_image, list) else [init_image])])
 
+		# encode the init images into latents and scale the latents
+		with self.stage_timer("vae_encode", init_image.shape[0]):
+			init_latent_dist = self.vae_encode(init_image.to(device=device, dtype=self.vae.dtype))
 
-	@torch.no_grad()
-	def decode (
-		self,
-		latents,
-		**kwargs,
-	):
-		image = self.vae.decode(latents).sample
-		#print('latents:', latents.shape, latents.dtype)
+		# sample the latent distributions as `init_latent_dist.sample` would, expanded for batch_size
+		mean, std = init_latent_dist.mean, init_latent_dist.std
+		if isinstance(generator, list):
+			# a sample per row, by its own generator
+			mean, std = (x.repeat(batch_size // n_images, 1, 1, 1) for x in (mean, std))
+			init_latents = mean + std * self.randn_rows(mean.shape, generator, dtype=mean.dtype)
+		else:
+			init_latents = (mean + std * self.randn_rows(mean.shape, generator, dtype=mean.dtype)).repeat(batch_size // n_images, 1, 1, 1)
+		init_latents = LATENTS_SCALING * init_latents
 
-		image = (image / 2 + 0.5).clamp(0, 1)
-		image = image.cpu().permute(0, 2, 3, 1).numpy()
+		# denoise the last `strength` of the schedule, multistep and higher order schedulers step through all of its
+		# timesteps from there, `order` of them per step
+		init_timestep = min(int(num_inference_steps * strength), num_inference_steps)
+		t_start = max(num_inference_steps - init_timestep, 0)
+		timesteps = scheduler.timesteps[t_start * getattr(scheduler, "order", 1) :]
 
-		image = self.numpy_to_pil(image)
+		# noise the latents to the first timestep
+		if len(timesteps) > 0:
+			noise = self.randn_rows(init_latents.shape, generator, dtype=init_latents.dtype)
+			init_latents = scheduler.add_noise(init_latents, noise, timesteps[:1].repeat(init_latents.shape[0]))
 
-		return dict(images=image)
+		# here `guidance_scale` is defined analog to the guidance weight `w` of equation (2)
+		# of the Imagen paper: https://arxiv.org/pdf/2205.11487.pdf . `guidance_scale = 1`
+		# corresponds to doing no classifier free guidance.
+		do_classifier_free_guidance = DenoisingRequest.uses_guidance(guidance_scale)
+
+		# get prompt text embeddings, with unconditional embeddings for classifier free guidance
+		text_embeddings = self._encode_prompt(prompts, device, 1, do_classifier_free_guidance, None)
+
+		return DenoisingRequest(
+			init_latents,
+			text_embeddings,
+			scheduler,
+			timesteps,
+			guidance_scale=guidance_scale,
+			extra_step_kwargs=self.prepare_extra_step_kwargs(generator, eta, scheduler=scheduler),
+			callback=callback,
+			callback_steps=callback_steps,
+			cancelled=cancelled,
+			guidance_window=guidance_window,
+			feature_reuse_interval=feature_reuse_interval,
+		)
 
 
 	@torch.no_grad()
 	def convert (
 		self,
 		prompt: Union[str, List[str]],
-		init_image: Union[torch.FloatTensor, PIL.Image.Image],
+		init_image: Union[torch.FloatTensor, PIL.Image.Image, List[PIL.Image.Image]],
 		strength: float = 0.8,
 		num_inference_steps: Optional[int] = 50,
-		guidance_scale: Optional[float] = 7.5,
+		guidance_scale: Optional[Union[float, List[float]]] = 7.5,
 		eta: Optional[float] = 0.0,
-		generator: Optional[torch.Generator] = None,
+		generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
 		output_type: Optional[str] = "pil",
+		callback: Optional[Callable[[int, int, torch.FloatTensor], None]] = None,
+		callback_steps: Optional[int] = 1,
+		return_latents: bool = False,
+		cancelled: Optional[Callable[[], bool]] = None,
+		guidance_window: Optional[Tuple[float, float]] = None,
+		feature_reuse_interval: Optional[int] = 1,
+		scheduler: Optional[str] = None,
 	):
 		r"""
 		Function invoked when calling the pipeline for generation.
 
 		Args:
 			prompt (`str` or `List[str]`):
-				The prompt or prompts to guide the image generation.
-			init_image (`torch.FloatTensor` or `PIL.Image.Image`):
-				`Image`, or tensor representing an image batch, that will be used as the starting point for the
-				process.
+				The prompt or prompts to guide the image generation, one for all images or one per image.
+			init_image (`torch.FloatTensor`, `PIL.Image.Image` or `List[PIL.Image.Image]`):
+				`Image`, list of images of the same size, or tensor representing an image batch, that will be used as
+				the starting point for the process. A single image is shared by all prompts. The images are encoded
+				and denoised in one batch.
 			strength (`float`, *optional*, defaults to 0.8):
 				Conceptually, indicates how much to transform the reference `init_image`. Must be between 0 and 1.
 				`init_image` will be used as a starting point, adding more noise to it the larger the `strength`. The
@@ -603,8 +1292,8 @@ class StableDiffusionPipeline (DiffusionPipeline):
 			num_inference_steps (`int`, *optional*, defaults to 50):
 				The number of denoising steps. More denoising steps usually lead to a higher quality image at the
 				expense of slower inference. This parameter will be modulated by `strength`.
-			guidance_scale (`float`, *optional*, defaults to 7.5):
-				Guidance scale as defined in [Classifier-Free Diffusion Guidance](https://arxiv.org/abs/2207.12598).
+			guidance_scale (`float` or `List[float]`, *optional*, defaults to 7.5):
+				Guidance scale, or one per denoising step, as defined in [Classifier-Free Diffusion Guidance](https://arxiv.org/abs/2207.12598).
 				`guidance_scale` is defined as `w` of equation 2. of [Imagen
 				Paper](https://arxiv.org/pdf/2205.11487.pdf). Guidance scale is enabled by setting `guidance_scale >
 				1`. Higher guidance scale encourages to generate images that are closely linked to the text `prompt`,
@@ -612,12 +1301,31 @@ class StableDiffusionPipeline (DiffusionPipeline):
 			eta (`float`, *optional*, defaults to 0.0):
 				Corresponds to parameter eta (η) in the DDIM paper: https://arxiv.org/abs/2010.02502. Only applies to
 				[`schedulers.DDIMScheduler`], will be ignored for others.
-			generator (`torch.Generator`, *optional*):
+			generator (`torch.Generator` or `List[torch.Generator]`, *optional*):
 				A [torch generator](https://pytorch.org/docs/stable/generated/torch.Generator.html) to make generation
-				deterministic.
+				deterministic, or one per image of the batch, which then does not depend on the other images.
 			output_type (`str`, *optional*, defaults to `"pil"`):
 				The output format of the generate image. Choose between
 				[PIL](https://pillow.readthedocs.io/en/stable/): `PIL.Image.Image` or `nd.array`.
+			callback (`Callable`, *optional*):
+				A function that will be called every `callback_steps` steps during inference. The function will be
+				called with the following arguments: `callback(step: int, timestep: int, latents: torch.FloatTensor)`.
+			callback_steps (`int`, *optional*, defaults to 1):
+				The frequency at which the `callback` function will be called. If not specified, the callback will be
+				called at every step.
+			return_latents (`bool`, *optional*, defaults to `False`):
+				Whether to return the denoised latents, moved to CPU in one copy, as `latents` of the result.
+			cancelled (`Callable`, *optional*):
+				A function polled between denoising steps, `DenoisingCancelled` is raised once it returns `True`.
+			guidance_window (`Tuple[float, float]`, *optional*):
+				The `(start, end)` fractions of the denoising steps that run classifier free guidance, e.g. `(0, 0.6)`.
+				Other steps run the UNet on the prompt only, at half the cost. All steps are guided if not provided.
+			feature_reuse_interval (`int`, *optional*, defaults to 1):
+				Run the deep UNet blocks every `feature_reuse_interval` steps only, reusing their features in the steps
+				between, for faster denoising at some loss of detail. `1` runs the full UNet at every step.
+			scheduler (`str`, *optional*):
+				The scheduler of this call, one of `SCHEDULERS`, with the config of `pipeline.scheduler`, e.g.
+				`"dpm_multistep"` for good images in 15 to 25 steps. `pipeline.scheduler` if not provided.
 
 		Returns:
 			[`~pipelines.stable_diffusion.StableDiffusionPipelineOutput`] or `tuple`:
@@ -626,6 +1334,51 @@ class StableDiffusionPipeline (DiffusionPipeline):
 			list of `bool`s denoting whether the corresponding generated image likely represents "not-safe-for-work"
 			(nsfw) content, according to the `safety_checker`.
 		"""
+		request = self.prepare_convert(
+			prompt,
+			init_image,
+			strength=strength,
+			num_inference_steps=num_inference_steps,
+			guidance_scale=guidance_scale,
+			eta=eta,
+			generator=generator,
+			callback=callback,
+			callback_steps=callback_steps,
+			cancelled=cancelled,
+			guidance_window=guidance_window,
+			feature_reuse_interval=feature_reuse_interval,
+			scheduler=scheduler,
+		)
+		self.denoise(request)
+
+		return self.finish_denoising(request, output_type=output_type, return_latents=return_latents)
+
+
+	@torch.no_grad()
+	def prepare_inpaint (
+		self,
+		prompt,
+		image,
+		mask_image,
+		num_inference_steps=50,
+		guidance_scale=7.5,
+		negative_prompt=None,
+		num_images_per_prompt=1,
+		eta=0.0,
+		generator=None,
+		latents=None,
+		callback=None,
+		callback_steps=1,
+		cancelled=None,
+		guidance_window=None,
+		feature_reuse_interval=1,
+		scheduler=None,
+	):
+		r"""
+		Encodes the prompt, mask and masked image of `inpaint`, see its arguments. Returns a `DenoisingRequest`.
+		"""
+		width, height = mask_image.width, mask_image.height
+
 		if isinstance(prompt, str):
 			batch_size = 1
 		elif isinstance(prompt, list):
@@ -633,130 +1386,104 @@ class StableDiffusionPipeline (DiffusionPipeline):
 		else:
 			raise ValueError(f"`prompt` has to be of type `str` or `list` but is {type(prompt)}")
 
-		if strength < 0 or strength > 1:
-			raise ValueError(f"The value of strength should in [0.0, 1.0] but is {strength}")
-
-		# set timesteps
-		accepts_offset = "offset" in set(inspect.signature(self.scheduler.set_timesteps).parameters.keys())
-		extra_set_kwargs = {}
-		offset = 0
-		if accepts_offset:
-			offset = 1
-			extra_set_kwargs["offset"] = 1
-
-		self.scheduler.set_timesteps(num_inference_steps, **extra_set_kwargs)
-
-		if not isinstance(init_image, torch.FloatTensor):
-			init_image = preprocess(init_image)
-
-		# encode the init image into latents and scale the latents
-		init_latent_dist = self.vae.encode(init_image.to(self.device)).latent_dist
-		init_latents = init_latent_dist.sample(generator=generator)
-		init_latents = LATENTS_SCALING * init_latents
-
-		# expand init_latents for batch_size
-		init_latents = torch.cat([init_latents] * batch_size)
+		if height % 8 != 0 or width % 8 != 0:
+			raise ValueError(f"`height` and `width` have to be divisible by 8 but are {height} and {width}.")
 
-		# get the original timestep using init_timestep
-		init_timestep = int(num_inference_steps * strength) + offset
-		init_timestep = min(init_timestep, num_inference_steps)
-		if isinstance(self.scheduler, LMSDiscreteScheduler):
-			timesteps = torch.tensor(
-				[num_inference_steps - init_timestep] * batch_size, dtype=torch.long, device=self.device
+		if (callback_steps is None) or (
+			callback_steps is not None and (not isinstance(callback_steps, int) or callback_steps <= 0)
+		):
+			raise ValueError(
+				f"`callback_steps` has to be a positive integer but is {callback_steps} of type"
+				f" {type(callback_steps)}."
 			)
-		else:
-			timesteps = self.scheduler.timesteps[-init_timestep]
-			timesteps = torch.tensor([timesteps] * batch_size, dtype=torch.long, device=self.device)
-
-		# add noise to latents using the timesteps
-		noise = torch.randn(init_latents.shape, generator=generator, device=self.device)
-		init_latents = self.scheduler.add_noise(init_latents, noise, timesteps).to(self.device)
-
-		# get prompt text embeddings
-		text_input = self.tokenizer(
-			prompt,
-			padding="max_length",
-			max_length=self.tokenizer.model_max_length,
-			truncation=True,
-			return_tensors="pt",
-		)
-		text_embeddings = self.text_encoder(text_input.input_ids.to(self.device))[0]
 
 		# here `guidance_scale` is defined analog to the guidance weight `w` of equation (2)
 		# of the Imagen paper: https://arxiv.org/pdf/2205.11487.pdf . `guidance_scale = 1`
 		# corresponds to doing no classifier free guidance.
-		do_classifier_free_guidance = guidance_scale > 1.0
-		# get unconditional embeddings for classifier free guidance
-		if do_classifier_free_guidance:
-			max_length = text_input.input_ids.shape[-1]
-			uncond_input = self.tokenizer(
-				[""] * batch_size, padding="max_length", max_length=max_length, return_tensors="pt"
-			)
-			uncond_embeddings = self.text_encoder(uncond_input.input_ids.to(self.device))[0]
-
-			# For classifier free guidance, we need to do two forward passes.
-			# Here we concatenate the unconditional and text embeddings into a single batch
-			# to avoid doing two forward passes
-			text_embeddings = torch.cat([uncond_embeddings, text_embeddings])
+		do_classifier_free_guidance = DenoisingRequest.uses_guidance(guidance_scale)
 
-		# prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
-		# eta (η) is only used with the DDIMScheduler, it will be ignored for other schedulers.
-		# eta corresponds to η in DDIM paper: https://arxiv.org/abs/2010.02502
-		# and should be between [0, 1]
-		accepts_eta = "eta" in set(inspect.signature(self.scheduler.step).parameters.keys())
-		extra_step_kwargs = {}
-		if accepts_eta:
-			extra_step_kwargs["eta"] = eta
-
-		latents = init_latents
+		device = self._execution_device
 
-		t_start = max(num_inference_steps - init_timestep + offset, 0)
-		for i, t in enumerate(self.progress_bar(self.scheduler.timesteps[t_start:])):
-			t_index = t_start + i
+		# get prompt text embeddings, with unconditional embeddings for classifier free guidance
+		text_embeddings = self._encode_prompt(
+			prompt, device, num_images_per_prompt, do_classifier_free_guidance, negative_prompt, truncation=False
+		)
 
-			# expand the latents if we are doing classifier free guidance
-			latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
+		# get the initial random noise unless the user supplied it
+		# Unlike in other pipelines, latents need to be generated in the target device
+		# for 1-to-1 results reproducibility with the CompVis implementation.
+		# However this currently doesn't work in `mps`.
+		num_channels_latents = self.vae.config.latent_channels
+		latents_shape = (batch_size * num_images_per_prompt, num_channels_latents, height // 8, width // 8)
+		latents_dtype = text_embeddings.dtype
+		if latents is None:
+			if device.type == "mps":
+				# randn does not exist on mps
+				latents = torch.randn(latents_shape, generator=generator, device="cpu", dtype=latents_dtype).to(
+					device
+				)
+			else:
+				latents = torch.randn(latents_shape, generator=generator, device=device, dtype=latents_dtype)
+		else:
+			if latents.shape != latents_shape:
+				raise ValueError(f"Unexpected latents shape, got {latents.shape}, expected {latents_shape}")
+			latents = latents.to(device)
 
-			# if we use LMSDiscreteScheduler, let's make sure latents are mulitplied by sigmas
-			if isinstance(self.scheduler, LMSDiscreteScheduler):
-				sigma = self.scheduler.sigmas[t_index]
-				# the model input needs to be scaled to match the continuous ODE formulation in K-LMS
-				latent_model_input = latent_model_input / ((sigma**2 + 1) ** 0.5)
-				latent_model_input = latent_model_input.to(self.unet.dtype)
-				t = t.to(self.unet.dtype)
+		# prepare mask and masked_image
+		mask, masked_image = prepare_mask_and_masked_image(image, mask_image)
+		mask = mask.to(device=device, dtype=text_embeddings.dtype)
+		masked_image = masked_image.to(device=device, dtype=text_embeddings.dtype)
 
-			# predict the noise residual
-			noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=text_embeddings).sample
+		# resize the mask to latents shape as we concatenate the mask to the latents
+		mask = torch.nn.functional.interpolate(mask, size=(height // 8, width // 8))
 
-			# perform guidance
-			if do_classifier_free_guidance:
-				noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-				noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+		# encode the mask image into latents space so we can concatenate it to the latents
+		with self.stage_timer("vae_encode", masked_image.shape[0]):
+			masked_image_latents = self.vae_encode(masked_image).sample(generator=generator)
+		masked_image_latents = LATENTS_SCALING * masked_image_latents
 
-			# compute the previous noisy sample x_t -> x_t-1
-			if isinstance(self.scheduler, LMSDiscreteScheduler):
-				latents = self.scheduler.step(noise_pred, t_index, latents, **extra_step_kwargs).prev_sample
-			else:
-				latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs).prev_sample
+		# duplicate mask and masked_image_latents for each generation per prompt, using mps friendly method
+		mask = mask.repeat(batch_size * num_images_per_prompt, 1, 1, 1)
+		masked_image_latents = masked_image_latents.repeat(batch_size * num_images_per_prompt, 1, 1, 1)
 
-		# scale and decode the image latents with vae
-		latents = 1 / LATENTS_SCALING * latents
-		image = self.vae.decode(latents.to(self.vae.dtype)).sample
+		mask = torch.cat([mask] * 2) if do_classifier_free_guidance else mask
+		masked_image_latents = (
+			torch.cat([masked_image_latents] * 2) if do_classifier_free_guidance else masked_image_latents
+		)
 
-		latent_codes = [encodeFloat32(l) for l in latents]
+		num_channels_mask = mask.shape[1]
+		num_channels_masked_image = masked_image_latents.shape[1]
 
-		image = (image / 2 + 0.5).clamp(0, 1)
-		image = image.cpu().permute(0, 2, 3, 1).numpy()
+		if num_channels_latents + num_channels_mask + num_channels_masked_image != self.unet.config.in_channels:
+			raise ValueError(
+				f"Incorrect configuration settings! The config of `pipeline.unet`: {self.unet.config} expects"
+				f" {self.unet.config.in_channels} but received `num_channels_latents`: {num_channels_latents} +"
+				f" `num_channels_mask`: {num_channels_mask} + `num_channels_masked_image`: {num_channels_masked_image}"
+				f" = {num_channels_latents+num_channels_masked_image+num_channels_mask}. Please verify the config of"
+				" `pipeline.unet` or your `mask_image` or `image` input."
+			)
 
-		# run safety checker
-		#safety_cheker_input = self.feature_extractor(self.numpy_to_pil(image), return_tensors="pt").to(self.device)
-		#image, has_nsfw_concept = self.safety_checker(images=image, clip_input=safety_cheker_input.pixel_values)
-		has_nsfw_concept = None
+		# set timesteps, on a scheduler owned by the request
+		scheduler = self.request_scheduler(scheduler)
+		scheduler.set_timesteps(num_inference_steps, device=device)
 
-		if output_type == "pil":
-			image = self.numpy_to_pil(image)
+		# scale the initial noise by the standard deviation required by the scheduler
+		latents = latents * scheduler.init_noise_sigma
 
-		return dict(images=image, latents=latent_codes, nsfw_content_detected=has_nsfw_concept)
+		return DenoisingRequest(
+			latents,
+			text_embeddings,
+			scheduler,
+			scheduler.timesteps,
+			guidance_scale=guidance_scale,
+			extra_step_kwargs=self.prepare_extra_step_kwargs(generator, eta, scheduler=scheduler),
+			conditioning=torch.cat([mask, masked_image_latents], dim=1),
+			callback=callback,
+			callback_steps=callback_steps,
+			cancelled=cancelled,
+			guidance_window=guidance_window,
+			feature_reuse_interval=feature_reuse_interval,
+		)
 
 
 	@torch.no_grad()
@@ -766,7 +1493,7 @@ class StableDiffusionPipeline (DiffusionPipeline):
 		image: Union[torch.FloatTensor, PIL.Image.Image],
 		mask_image: Union[torch.FloatTensor, PIL.Image.Image],
 		num_inference_steps: Optional[int] = 50,
-		guidance_scale: Optional[float] = 7.5,
+		guidance_scale: Optional[Union[float, List[float]]] = 7.5,
 		negative_prompt: Optional[Union[str, List[str]]] = None,
 		num_images_per_prompt: Optional[int] = 1,
 		eta: Optional[float] = 0.0,
@@ -775,6 +1502,10 @@ class StableDiffusionPipeline (DiffusionPipeline):
 		output_type: Optional[str] = "pil",
 		callback: Optional[Callable[[int, int, torch.FloatTensor], None]] = None,
 		callback_steps: Optional[int] = 1,
+		cancelled: Optional[Callable[[], bool]] = None,
+		guidance_window: Optional[Tuple[float, float]] = None,
+		feature_reuse_interval: Optional[int] = 1,
+		scheduler: Optional[str] = None,
 	):
 		r"""
 		Function invoked when calling the pipeline for generation.
@@ -797,8 +1528,8 @@ class StableDiffusionPipeline (DiffusionPipeline):
 			num_inference_steps (`int`, *optional*, defaults to 50):
 				The number of denoising steps. More denoising steps usually lead to a higher quality image at the
 				expense of slower inference.
-			guidance_scale (`float`, *optional*, defaults to 7.5):
-				Guidance scale as defined in [Classifier-Free Diffusion Guidance](https://arxiv.org/abs/2207.12598).
+			guidance_scale (`float` or `List[float]`, *optional*, defaults to 7.5):
+				Guidance scale, or one per denoising step, as defined in [Classifier-Free Diffusion Guidance](https://arxiv.org/abs/2207.12598).
 				`guidance_scale` is defined as `w` of equation 2. of [Imagen
 				Paper](https://arxiv.org/pdf/2205.11487.pdf). Guidance scale is enabled by setting `guidance_scale >
 				1`. Higher guidance scale encourages to generate images that are closely linked to the text `prompt`,
@@ -830,6 +1561,17 @@ class StableDiffusionPipeline (DiffusionPipeline):
 			callback_steps (`int`, *optional*, defaults to 1):
 				The frequency at which the `callback` function will be called. If not specified, the callback will be
 				called at every step.
+			cancelled (`Callable`, *optional*):
+				A function polled between denoising steps, `DenoisingCancelled` is raised once it returns `True`.
+			guidance_window (`Tuple[float, float]`, *optional*):
+				The `(start, end)` fractions of the denoising steps that run classifier free guidance, e.g. `(0, 0.6)`.
+				Other steps run the UNet on the prompt only, at half the cost. All steps are guided if not provided.
+			feature_reuse_interval (`int`, *optional*, defaults to 1):
+				Run the deep UNet blocks every `feature_reuse_interval` steps only, reusing their features in the steps
+				between, for faster denoising at some loss of detail. `1` runs the full UNet at every step.
+			scheduler (`str`, *optional*):
+				The scheduler of this call, one of `SCHEDULERS`, with the config of `pipeline.scheduler`, e.g.
+				`"dpm_multistep"` for good images in 15 to 25 steps. `pipeline.scheduler` if not provided.
 
 		Returns:
 			[`~pipelines.stable_diffusion.StableDiffusionPipelineOutput`] or `tuple`:
@@ -839,209 +1581,26 @@ class StableDiffusionPipeline (DiffusionPipeline):
 			(nsfw) content, according to the `safety_checker`.
 		"""
 
-		width, height = mask_image.width, mask_image.height
-
-		if isinstance(prompt, str):
-			batch_size = 1
-		elif isinstance(prompt, list):
-			batch_size = len(prompt)
-		else:
-			raise ValueError(f"`prompt` has to be of type `str` or `list` but is {type(prompt)}")
-
-		if height % 8 != 0 or width % 8 != 0:
-			raise ValueError(f"`height` and `width` have to be divisible by 8 but are {height} and {width}.")
-
-		if (callback_steps is None) or (
-			callback_steps is not None and (not isinstance(callback_steps, int) or callback_steps <= 0)
-		):
-			raise ValueError(
-				f"`callback_steps` has to be a positive integer but is {callback_steps} of type"
-				f" {type(callback_steps)}."
-			)
-
-		# get prompt text embeddings
-		text_inputs = self.tokenizer(
+		request = self.prepare_inpaint(
 			prompt,
-			padding="max_length",
-			max_length=self.tokenizer.model_max_length,
-			return_tensors="pt",
-		)
-		text_input_ids = text_inputs.input_ids
-
-		if text_input_ids.shape[-1] > self.tokenizer.model_max_length:
-			removed_text = self.tokenizer.batch_decode(text_input_ids[:, self.tokenizer.model_max_length :])
-			logging.warning(
-				"The following part of your input was truncated because CLIP can only handle sequences up to"
-				f" {self.tokenizer.model_max_length} tokens: {removed_text}"
-			)
-			text_input_ids = text_input_ids[:, : self.tokenizer.model_max_length]
-		text_embeddings = self.text_encoder(text_input_ids.to(self.device))[0]
-
-		# duplicate text embeddings for each generation per prompt, using mps friendly method
-		bs_embed, seq_len, _ = text_embeddings.shape
-		text_embeddings = text_embeddings.repeat(1, num_images_per_prompt, 1)
-		text_embeddings = text_embeddings.view(bs_embed * num_images_per_prompt, seq_len, -1)
-
-		# here `guidance_scale` is defined analog to the guidance weight `w` of equation (2)
-		# of the Imagen paper: https://arxiv.org/pdf/2205.11487.pdf . `guidance_scale = 1`
-		# corresponds to doing no classifier free guidance.
-		do_classifier_free_guidance = guidance_scale > 1.0
-		# get unconditional embeddings for classifier free guidance
-		if do_classifier_free_guidance:
-			uncond_tokens: List[str]
-			if negative_prompt is None:
-				uncond_tokens = [""]
-			elif type(prompt) is not type(negative_prompt):
-				raise TypeError(
-					f"`negative_prompt` should be the same type to `prompt`, but got {type(negative_prompt)} !="
-					f" {type(prompt)}."
-				)
-			elif isinstance(negative_prompt, str):
-				uncond_tokens = [negative_prompt]
-			elif batch_size != len(negative_prompt):
-				raise ValueError(
-					f"`negative_prompt`: {negative_prompt} has batch size {len(negative_prompt)}, but `prompt`:"
-					f" {prompt} has batch size {batch_size}. Please make sure that passed `negative_prompt` matches"
-					" the batch size of `prompt`."
-				)
-			else:
-				uncond_tokens = negative_prompt
-
-			max_length = text_input_ids.shape[-1]
-			uncond_input = self.tokenizer(
-				uncond_tokens,
-				padding="max_length",
-				max_length=max_length,
-				truncation=True,
-				return_tensors="pt",
-			)
-			uncond_embeddings = self.text_encoder(uncond_input.input_ids.to(self.device))[0]
-
-			# duplicate unconditional embeddings for each generation per prompt, using mps friendly method
-			seq_len = uncond_embeddings.shape[1]
-			uncond_embeddings = uncond_embeddings.repeat(batch_size, num_images_per_prompt, 1)
-			uncond_embeddings = uncond_embeddings.view(batch_size * num_images_per_prompt, seq_len, -1)
-
-			# For classifier free guidance, we need to do two forward passes.
-			# Here we concatenate the unconditional and text embeddings into a single batch
-			# to avoid doing two forward passes
-			text_embeddings = torch.cat([uncond_embeddings, text_embeddings])
-
-		# get the initial random noise unless the user supplied it
-		# Unlike in other pipelines, latents need to be generated in the target device
-		# for 1-to-1 results reproducibility with the CompVis implementation.
-		# However this currently doesn't work in `mps`.
-		num_channels_latents = self.vae.config.latent_channels
-		latents_shape = (batch_size * num_images_per_prompt, num_channels_latents, height // 8, width // 8)
-		latents_dtype = text_embeddings.dtype
-		if latents is None:
-			if self.device.type == "mps":
-				# randn does not exist on mps
-				latents = torch.randn(latents_shape, generator=generator, device="cpu", dtype=latents_dtype).to(
-					self.device
-				)
-			else:
-				latents = torch.randn(latents_shape, generator=generator, device=self.device, dtype=latents_dtype)
-		else:
-			if latents.shape != latents_shape:
-				raise ValueError(f"Unexpected latents shape, got {latents.shape}, expected {latents_shape}")
-			latents = latents.to(self.device)
-
-		# prepare mask and masked_image
-		mask, masked_image = prepare_mask_and_masked_image(image, mask_image)
-		mask = mask.to(device=self.device, dtype=text_embeddings.dtype)
-		masked_image = masked_image.to(device=self.device, dtype=text_embeddings.dtype)
-
-		# resize the mask to latents shape as we concatenate the mask to the latents
-		mask = torch.nn.functional.interpolate(mask, size=(height // 8, width // 8))
-
-		# encode the mask image into latents space so we can concatenate it to the latents
-		masked_image_latents = self.vae.encode(masked_image).latent_dist.sample(generator=generator)
-		masked_image_latents = LATENTS_SCALING * masked_image_latents
-
-		# duplicate mask and masked_image_latents for each generation per prompt, using mps friendly method
-		mask = mask.repeat(batch_size * num_images_per_prompt, 1, 1, 1)
-		masked_image_latents = masked_image_latents.repeat(batch_size * num_images_per_prompt, 1, 1, 1)
-
-		mask = torch.cat([mask] * 2) if do_classifier_free_guidance else mask
-		masked_image_latents = (
-			torch.cat([masked_image_latents] * 2) if do_classifier_free_guidance else masked_image_latents
+			image,
+			mask_image,
+			num_inference_steps=num_inference_steps,
+			guidance_scale=guidance_scale,
+			negative_prompt=negative_prompt,
+			num_images_per_prompt=num_images_per_prompt,
+			eta=eta,
+			generator=generator,
+			latents=latents,
+			callback=callback,
+			callback_steps=callback_steps,
+			cancelled=cancelled,
+			guidance_window=guidance_window,
+			feature_reuse_interval=feature_reuse_interval,
+			scheduler=scheduler,
 		)
+		self.denoise(request)
 
-		num_channels_mask = mask.shape[1]
-		num_channels_masked_image = masked_image_latents.shape[1]
-
-		if num_channels_latents + num_channels_mask + num_channels_masked_image != self.unet.config.in_channels:
-			raise ValueError(
-				f"Incorrect configuration settings! The config of `pipeline.unet`: {self.unet.config} expects"
-				f" {self.unet.config.in_channels} but received `num_channels_latents`: {num_channels_latents} +"
-				f" `num_channels_mask`: {num_channels_mask} + `num_channels_masked_image`: {num_channels_masked_image}"
-				f" = {num_channels_latents+num_channels_masked_image+num_channels_mask}. Please verify the config of"
-				" `pipeline.unet` or your `mask_image` or `image` input."
-			)
-
-		# set timesteps
-		self.scheduler.set_timesteps(num_inference_steps)
-
-		# Some schedulers like PNDM have timesteps as arrays
-		# It's more optimized to move all timesteps to correct device beforehand
-		timesteps_tensor = self.scheduler.timesteps.to(self.device)
-
-		# scale the initial noise by the standard deviation required by the scheduler
-		latents = latents * self.scheduler.init_noise_sigma
-
-		# prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
-		# eta (η) is only used with the DDIMScheduler, it will be ignored for other schedulers.
-		# eta corresponds to η in DDIM paper: https://arxiv.org/abs/2010.02502
-		# and should be between [0, 1]
-		accepts_eta = "eta" in set(inspect.signature(self.scheduler.step).parameters.keys())
-		extra_step_kwargs = {}
-		if accepts_eta:
-			extra_step_kwargs["eta"] = eta
-
-		for i, t in enumerate(self.progress_bar(timesteps_tensor)):
-			# expand the latents if we are doing classifier free guidance
-			latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
-
-			# concat latents, mask, masked_image_latents in the channel dimension
-			latent_model_input = torch.cat([latent_model_input, mask, masked_image_latents], dim=1)
-
-			latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
-
-			# predict the noise residual
-			noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=text_embeddings).sample
-
-			# perform guidance
-			if do_classifier_free_guidance:
-				noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-				noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
-
-			# compute the previous noisy sample x_t -> x_t-1
-			latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs).prev_sample
-
-			# call the callback, if provided
-			if callback is not None and i % callback_steps == 0:
-				callback(i, t, latents)
-
-		latents = 1 / LATENTS_SCALING * latents
-		image = self.vae.decode(latents).sample
-
-		image = (image / 2 + 0.5).clamp(0, 1)
-
-		# we always cast to float32 as this does not cause significant overhead and is compatible with bfloa16
-		image = image.cpu().permute(0, 2, 3, 1).float().numpy()
-
-		'''if self.safety_checker is not None:
-			safety_checker_input = self.feature_extractor(self.numpy_to_pil(image), return_tensors="pt").to(
-				self.device
-			)
-			image, has_nsfw_concept = self.safety_checker(
-				images=image, clip_input=safety_checker_input.pixel_values.to(text_embeddings.dtype)
-			)
-		else:'''
-		has_nsfw_concept = None
-
-		if output_type == "pil":
-			image = self.numpy_to_pil(image)
+		result = self.finish_denoising(request, output_type=output_type)
 
-		return dict(images=image, nsfw_content_detected=has_nsfw_concept)
+		return dict(images=result["images"], nsfw_content_detected=result["nsfw_content_detected"])
@@ -0,0 +1,3 @@
+
+from .embeddingCache import EmbeddingCache
+from .sequentialOffload import SequentialOffload
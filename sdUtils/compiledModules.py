@@ -0,0 +1,69 @@
+
+import collections
+import contextlib
+import threading
+import torch
+
+
+
+class UNetSample (torch.nn.Module):
+	# tensor in, tensor out, as tracing needs
+	def __init__ (self, unet):
+		super().__init__()
+		self.unet = unet
+
+
+	def forward (self, sample, timestep, encoder_hidden_states):
+		return self.unet(sample, timestep, encoder_hidden_states=encoder_hidden_states).sample
+
+
+class VaeDecodeSample (torch.nn.Module):
+	def __init__ (self, vae):
+		super().__init__()
+		self.vae = vae
+
+
+	def forward (self, latents):
+		return self.vae.decode(latents).sample
+
+
+class ShapeCompiled:
+	r"""
+	Runs `module` through graphs traced by `torch.jit.trace`, one per shapes, dtypes and devices of the inputs, e.g. per
+	resolution bucket and batch size. The `cache_size` most recently used graphs are kept.
+
+	Tracing runs within `timer()` if provided. Traced graphs bake in the device placement of weights, call `clear()`
+	after moving the module.
+	"""
+
+	def __init__ (self, module, cache_size=16, timer=None):
+		self.module = module
+		self.cache_size = cache_size
+		self.timer = timer or contextlib.nullcontext
+
+		self.graphs = collections.OrderedDict()
+		self.lock = threading.Lock()
+
+
+	def __call__ (self, *inputs):
+		key = tuple((tuple(x.shape), x.dtype, x.device) for x in inputs)
+		with self.lock:
+			graph = self.graphs.get(key)
+			if graph is not None:
+				self.graphs.move_to_end(key)
+
+		if graph is None:
+			with torch.no_grad(), self.timer():
+				graph = torch.jit.trace(self.module, inputs, check_trace=False)
+
+			with self.lock:
+				self.graphs[key] = graph
+				while len(self.graphs) > self.cache_size:
+					self.graphs.popitem(last=False)
+
+		return graph(*inputs)
+
+
+	def clear (self):
+		with self.lock:
+			self.graphs.clear()
@@ -0,0 +1,69 @@
+
+import threading
+from collections import OrderedDict
+
+
+
+class EmbeddingCache:
+	r"""
+	A size bounded LRU map from text keys to text encoder hidden states.
+
+	Keys are tuples of `(model, text, max_length, truncation)`, so one cache can be shared by several pipelines.
+	`hits` and `misses` count lookups since creation.
+	"""
+
+	def __init__ (self, max_size=256):
+		self.max_size = max_size
+
+		self.entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+
+
+	def get (self, key):
+		with self.lock:
+			value = self.entries.get(key)
+			if value is None:
+				self.misses += 1
+				return None
+
+			self.entries.move_to_end(key)
+			self.hits += 1
+
+			return value
+
+
+	def put (self, key, value):
+		with self.lock:
+			self.entries[key] = value
+			self.entries.move_to_end(key)
+
+			while len(self.entries) > self.max_size:
+				self.entries.popitem(last=False)
+
+
+	def resize (self, max_size):
+		with self.lock:
+			self.max_size = max_size
+
+			while len(self.entries) > self.max_size:
+				self.entries.popitem(last=False)
+
+
+	def clear (self, model=None):
+		with self.lock:
+			if model is None:
+				self.entries.clear()
+			else:
+				for key in [key for key in self.entries if key[0] == model]:
+					del self.entries[key]
+
+
+	def stats (self):
+		return {
+			'size': len(self.entries),
+			'max_size': self.max_size,
+			'hits': self.hits,
+			'misses': self.misses,
+		}
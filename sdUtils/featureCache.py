@@ -0,0 +1,86 @@
+
+import torch
+
+
+
+def blockForward (block, sample, emb, encoder_hidden_states, **kwargs):
+	# cross attention blocks take the text embeddings
+	if getattr(block, 'attentions', None) is not None:
+		return block(hidden_states=sample, temb=emb, encoder_hidden_states=encoder_hidden_states, **kwargs)
+
+	return block(hidden_states=sample, temb=emb, **kwargs)
+
+
+def timeEmbedding (unet, timestep, batch_size, device, dtype):
+	timesteps = torch.as_tensor(timestep, device=device)
+	if timesteps.ndim == 0:
+		timesteps = timesteps[None]
+	timesteps = timesteps.expand(batch_size)
+
+	# time_proj has no weights and returns float32, cast to the UNet dtype
+	return unet.time_embedding(unet.time_proj(timesteps).to(dtype=dtype))
+
+
+def featureReuseForward (unet, sample, timestep, encoder_hidden_states, deep_rows, cached=None, depth=1):
+	r"""
+	Runs `unet` as its forward does, except for the deep blocks, all but the outer `depth` levels of down and up blocks,
+	which only run on the rows of `deep_rows`. The other rows take their deep features, the input of the outer up blocks,
+	from `cached`, in row order. Adjacent denoising steps have similar deep features, so they can be reused for a few
+	steps while the shallow blocks follow the latents, as in DeepCache (https://arxiv.org/abs/2312.00858).
+
+	Returns the UNet output and the deep features of all rows.
+	"""
+	# upsampling follows the sizes of skip connections when the sample is not a multiple of the overall factor
+	forward_upsample_size = any(size % 2 ** unet.num_upsamplers != 0 for size in sample.shape[-2:])
+
+	emb = timeEmbedding(unet, timestep, sample.shape[0], sample.device, unet.dtype)
+
+	sample = unet.conv_in(sample)
+	res_samples = (sample,)
+	for block in unet.down_blocks[:depth]:
+		sample, res = blockForward(block, sample, emb, encoder_hidden_states)
+		res_samples += res
+
+	deep = None
+	if len(deep_rows) > 0:
+		rows = torch.as_tensor(deep_rows, device=sample.device, dtype=torch.long)
+		hidden, e, states = sample[rows], emb[rows], encoder_hidden_states[rows]
+		res = tuple(r[rows] for r in res_samples)
+
+		for block in unet.down_blocks[depth:]:
+			hidden, block_res = blockForward(block, hidden, e, states)
+			res += block_res
+
+		hidden = unet.mid_block(hidden, e, encoder_hidden_states=states)
+
+		for block in unet.up_blocks[:-depth]:
+			res, block_res = res[:-len(block.resnets)], res[-len(block.resnets):]
+			upsample_size = res[-1].shape[2:] if forward_upsample_size else None
+			hidden = blockForward(block, hidden, e, states, res_hidden_states_tuple=block_res, upsample_size=upsample_size)
+
+		deep = hidden
+
+	if cached is None:
+		features = deep
+	elif deep is None:
+		features = cached
+	else:
+		selected = torch.zeros(sample.shape[0], dtype=torch.bool, device=sample.device)
+		selected[rows] = True
+		features = deep.new_empty((sample.shape[0], *deep.shape[1:]))
+		features[selected] = deep
+		features[~selected] = cached.to(deep.dtype)
+
+	# the outer up blocks take the skip connections of the outer down blocks
+	up_blocks = unet.up_blocks[-depth:]
+	res = res_samples[:sum(len(block.resnets) for block in up_blocks)]
+	hidden = features
+	for i, block in enumerate(up_blocks):
+		res, block_res = res[:-len(block.resnets)], res[-len(block.resnets):]
+		upsample_size = res[-1].shape[2:] if forward_upsample_size and i < len(up_blocks) - 1 else None
+		hidden = blockForward(block, hidden, emb, encoder_hidden_states, res_hidden_states_tuple=block_res, upsample_size=upsample_size)
+
+	hidden = unet.conv_norm_out(hidden)
+	hidden = unet.conv_act(hidden)
+
+	return unet.conv_out(hidden), features
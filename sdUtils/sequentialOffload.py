@@ -0,0 +1,74 @@
+
+import contextlib
+import threading
+import torch
+
+
+
+class SequentialOffload:
+	r"""
+	Keeps weights of registered modules in CPU memory, pinned for fast transfers to CUDA devices, and puts one module
+	at a time on `device`, for the phase it runs in.
+
+	A module stays on the device after its phase until another module is needed, so consecutive denoising steps do not
+	move the UNet again. Taking a module off the device is free: inference does not change weights, so the host copies
+	are kept and the device copies are dropped. One instance can serve several pipelines that share modules.
+	"""
+
+	def __init__ (self, device):
+		self.device = torch.device(device)
+
+		# id(module) -> [(tensor, host data)]
+		self.tensors = {}
+		self.resident = set()
+		self.active = {}
+		self.condition = threading.Condition()
+
+
+	def register (self, module):
+		key = id(module)
+		if key in self.tensors:
+			return
+
+		module.to('cpu')
+		tensors = list(module.parameters()) + list(module.buffers())
+		if self.device.type == 'cuda':
+			for tensor in tensors:
+				tensor.data = tensor.data.pin_memory()
+
+		self.tensors[key] = [(tensor, tensor.data) for tensor in tensors]
+
+
+	def evict (self, key):
+		for tensor, host in self.tensors[key]:
+			tensor.data = host
+		self.resident.discard(key)
+
+
+	@contextlib.contextmanager
+	def use (self, module):
+		key = id(module)
+		if key not in self.tensors:
+			yield
+			return
+
+		with self.condition:
+			# modules running on other threads finish their phase first
+			self.condition.wait_for(lambda: all(not self.active.get(other) for other in self.resident if other != key))
+			for other in list(self.resident):
+				if other != key:
+					self.evict(other)
+
+			if key not in self.resident:
+				for tensor, host in self.tensors[key]:
+					tensor.data = host.to(self.device, non_blocking=True)
+				self.resident.add(key)
+
+			self.active[key] = self.active.get(key, 0) + 1
+
+		try:
+			yield
+		finally:
+			with self.condition:
+				self.active[key] -= 1
+				self.condition.notify_all()
@@ -0,0 +1,77 @@
+
+import torch
+from diffusers.models.vae import DiagonalGaussianDistribution
+
+
+
+def tileStarts (size, tile, overlap):
+	# offsets of tiles covering `size` with at least `overlap` in common, the last one aligned to the end
+	if size <= tile:
+		return [0]
+
+	return list(range(0, size - tile, tile - overlap)) + [size - tile]
+
+
+def blendMask (height, width, overlap, top, bottom, left, right):
+	# weights ramping up across the overlaps with neighboring tiles, 1 elsewhere
+	mask = torch.ones(height, width)
+	overlap = min(overlap, height, width)
+	if overlap <= 0:
+		return mask
+
+	ramp = torch.arange(1, overlap + 1, dtype=torch.float32) / (overlap + 1)
+	if top:
+		mask[:overlap] *= ramp[:, None]
+	if bottom:
+		mask[-overlap:] *= ramp.flip(0)[:, None]
+	if left:
+		mask[:, :overlap] *= ramp[None]
+	if right:
+		mask[:, -overlap:] *= ramp.flip(0)[None]
+
+	return mask
+
+
+def tiledApply (fn, x, tile, overlap, scale):
+	r"""
+	Applies `fn` to overlapping `tile` x `tile` crops of `x` of shape `(N, C, H, W)` and blends the outputs, which are
+	`scale` times the size of the crops. Peak memory of `fn` is bounded by the tile size instead of the image size.
+	"""
+	n, _, height, width = x.shape
+	ys, xs = tileStarts(height, tile, overlap), tileStarts(width, tile, overlap)
+
+	output, weights = None, None
+	for iy, y in enumerate(ys):
+		for ix, x0 in enumerate(xs):
+			out = fn(x[:, :, y:y + tile, x0:x0 + tile])
+			if output is None:
+				output = out.new_zeros(n, out.shape[1], round(height * scale), round(width * scale), dtype=torch.float32)
+				weights = out.new_zeros(1, 1, *output.shape[2:], dtype=torch.float32)
+
+			oy, ox = round(y * scale), round(x0 * scale)
+			oh, ow = out.shape[2:]
+			mask = blendMask(oh, ow, round(overlap * scale), iy > 0, iy < len(ys) - 1, ix > 0, ix < len(xs) - 1).to(out.device)
+
+			output[:, :, oy:oy + oh, ox:ox + ow] += out.float() * mask
+			weights[:, :, oy:oy + oh, ox:ox + ow] += mask
+
+	return (output / weights).to(out.dtype)
+
+
+def tiledDecode (vae, latents, tile_size=64, overlap=8):
+	# `tile_size` and `overlap` are in latent pixels
+	scale = 2 ** (len(vae.config.block_out_channels) - 1)
+
+	return tiledApply(lambda tile: vae.decode(tile).sample, latents, tile_size, overlap, scale)
+
+
+def tiledEncode (vae, images, tile_size=512, overlap=64):
+	r"""
+	Encodes `images` tile by tile, `tile_size` and `overlap` in image pixels, multiples of the VAE scale factor.
+
+	Mean and log variance of the tiles are blended, returns the `latent_dist` that `vae.encode` would.
+	"""
+	scale = 2 ** (len(vae.config.block_out_channels) - 1)
+	parameters = tiledApply(lambda tile: vae.encode(tile).latent_dist.parameters, images, tile_size, overlap, 1 / scale)
+
+	return DiagonalGaussianDistribution(parameters)
@@ -0,0 +1,131 @@
+
+import os
+import json
+import tempfile
+
+import torch
+from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+from transformers.models.clip.tokenization_clip import bytes_to_unicode
+from diffusers.models import AutoencoderKL, UNet2DConditionModel
+from diffusers.schedulers import DDIMScheduler
+
+
+
+# model paths resolved to random-weight pipelines instead of checkpoints
+TINY_MODELS = ('tiny', 'tiny-inpainting')
+
+TINY_HIDDEN_SIZE = 32
+
+
+def buildTinyTokenizer ():
+	# byte-level vocabulary without merges: every character is a token, enough to exercise padding and truncation
+	chars = list(bytes_to_unicode().values())
+	vocab = chars + [c + '</w>' for c in chars] + ['<|startoftext|>', '<|endoftext|>']
+
+	directory = tempfile.mkdtemp(prefix='tiny-tokenizer-')
+	vocab_path = os.path.join(directory, 'vocab.json')
+	merges_path = os.path.join(directory, 'merges.txt')
+
+	with open(vocab_path, 'w', encoding='utf-8') as file:
+		json.dump({token: i for i, token in enumerate(vocab)}, file)
+	with open(merges_path, 'w', encoding='utf-8') as file:
+		file.write('#version: 0.2\n')
+
+	return CLIPTokenizer(vocab_path, merges_path, model_max_length=77)
+
+
+def buildTinyPipeline (inpainting=False, seed=0):
+	r"""
+	Builds a `StableDiffusionPipeline` with the real architecture at toy sizes and random weights, with a 9 channel UNet
+	input for `inpainting`.
+
+	Images are noise, but the whole serving path runs on CPU in a fraction of a second per step.
+	"""
+	from pipeline_stable_diffusion import StableDiffusionPipeline
+
+	# components are seeded one by one, so the inpainting variant has the same VAE and text encoder, as real ones do
+	torch.manual_seed(seed)
+	unet = UNet2DConditionModel(
+		sample_size=8,
+		in_channels=9 if inpainting else 4,
+		out_channels=4,
+		layers_per_block=1,
+		block_out_channels=(32, 64),
+		down_block_types=('DownBlock2D', 'CrossAttnDownBlock2D'),
+		up_block_types=('CrossAttnUpBlock2D', 'UpBlock2D'),
+		cross_attention_dim=TINY_HIDDEN_SIZE,
+		attention_head_dim=8,
+	)
+	torch.manual_seed(seed)
+	vae = AutoencoderKL(
+		in_channels=3,
+		out_channels=3,
+		down_block_types=('DownEncoderBlock2D',) * 4,
+		up_block_types=('UpDecoderBlock2D',) * 4,
+		block_out_channels=(32,) * 4,
+		layers_per_block=1,
+		latent_channels=4,
+		norm_num_groups=32,
+	)
+	torch.manual_seed(seed)
+	text_encoder = CLIPTextModel(CLIPTextConfig(
+		hidden_size=TINY_HIDDEN_SIZE,
+		intermediate_size=64,
+		num_hidden_layers=2,
+		num_attention_heads=4,
+		max_position_embeddings=77,
+		vocab_size=514,
+		bos_token_id=512,
+		eos_token_id=513,
+		pad_token_id=513,
+	))
+	scheduler = DDIMScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule='scaled_linear',
+		clip_sample=False, set_alpha_to_one=False, steps_offset=1)
+
+	return StableDiffusionPipeline(vae=vae, text_encoder=text_encoder, tokenizer=buildTinyTokenizer(), unet=unet, scheduler=scheduler)
+
+
+def saveTinyTextGenerator (directory, tokenizer, seed=0):
+	# a random-weight `ClipTextGenerator` over the vocabulary of `tokenizer`, loadable by `textGen.SentenceGenerator`
+	from textGen.transformers.clipTextGenerator import ClipTextGenerator, ClipTextGeneratorConfig
+
+	torch.manual_seed(seed)
+
+	config = ClipTextGeneratorConfig(
+		vocab_size=len(tokenizer),
+		hidden_size=TINY_HIDDEN_SIZE,
+		intermediate_size=64,
+		num_hidden_layers=2,
+		num_attention_heads=4,
+		max_position_embeddings=tokenizer.model_max_length,
+		bos_token_id=tokenizer.bos_token_id,
+		eos_token_id=tokenizer.eos_token_id,
+		pad_token_id=tokenizer.pad_token_id,
+	)
+	ClipTextGenerator(config).save_pretrained(directory)
+
+	return directory
+
+
+def saveTinyFillMask (directory, words, seed=0):
+	# a random-weight BERT masked language model over `words`, loadable by `sentenceGen.SentenceGenerator`
+	from transformers import BertConfig, BertForMaskedLM, BertTokenizer
+
+	torch.manual_seed(seed)
+
+	vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + sorted(set(words) - {'[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'})
+	os.makedirs(directory, exist_ok=True)
+	vocab_path = os.path.join(directory, 'vocab.txt')
+	with open(vocab_path, 'w', encoding='utf-8') as file:
+		file.write('\n'.join(vocab) + '\n')
+
+	BertTokenizer(vocab_path).save_pretrained(directory)
+	BertForMaskedLM(BertConfig(
+		vocab_size=len(vocab),
+		hidden_size=TINY_HIDDEN_SIZE,
+		intermediate_size=64,
+		num_hidden_layers=2,
+		num_attention_heads=4,
+	)).save_pretrained(directory)
+
+	return directory
@@ -8,9 +8,9 @@ from transformers import BertTokenizer, pipeline
 
 
 class SentenceGenerator:
-	def __init__(self, templates_path, reserved_path, device=-1):
-		self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
-		self.unmasker = pipeline('fill-mask', model='bert-base-uncased', device=device)
+	def __init__(self, templates_path, reserved_path, device=-1, model_path='bert-base-uncased'):
+		self.tokenizer = BertTokenizer.from_pretrained(model_path)
+		self.unmasker = pipeline('fill-mask', model=model_path, device=device)
 
 		with open(reserved_path, 'r') as file:
 			text = file.read()
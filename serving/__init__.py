@@ -0,0 +1,11 @@
+
+from .requestBatcher import RequestBatcher
+from .jobQueue import Job, JobQueue, JobCancelled
+from .resultCache import ResultCache
+from .admissionControl import AdmissionControl, AdmissionRejected
+from .metrics import Metrics
+from .lazyModel import LazyModel
+from .stepEngine import StepEngine
+from .pipelineRunner import PipelineRunner, loadPipeline, loadTokenizer
+from .modelRegistry import ModelRegistry
+from .workerPool import WorkerPool
@@ -0,0 +1,90 @@
+
+import collections
+import math
+import threading
+import time
+
+
+
+class AdmissionRejected (Exception):
+	def __init__ (self, lane, retry_after):
+		super().__init__(f'{lane} backlog is full, retry after {retry_after} seconds.')
+
+		self.lane = lane
+		self.retry_after = retry_after
+
+
+class AdmissionControl:
+	r"""
+	Bounds the backlog of unfinished jobs per lane, e.g. interactive and bulk traffic, by their estimated cost.
+
+	`budgets` maps lanes to the max total cost of their unfinished jobs, `None` or 0 for no limit. A job is admitted when
+	it fits in the budget of its lane, or when the lane is idle. Otherwise `AdmissionRejected` tells when enough of the
+	backlog should be done, from the throughput of the last `rate_window` seconds (`default_rate` cost per second
+	before anything is done).
+	"""
+
+	def __init__ (self, budgets, default_rate=10., rate_window=60):
+		self.budgets = budgets
+		self.default_rate = default_rate
+		self.rate_window = rate_window
+
+		self.outstanding = {lane: [] for lane in budgets}
+		self.completions = collections.deque()
+		self.lock = threading.Lock()
+
+
+	def refresh (self):
+		for lane, entries in self.outstanding.items():
+			for job, cost in entries:
+				if job.finished is not None and job.status == 'done' and job.started is not None:
+					self.completions.append((job.started, job.finished, cost))
+
+			self.outstanding[lane] = [(job, cost) for job, cost in entries if job.finished is None]
+
+		deadline = time.time() - self.rate_window
+		while self.completions and self.completions[0][1] < deadline:
+			self.completions.popleft()
+
+
+	def rate (self):
+		# cost done per second over the busy span of recent jobs
+		if not self.completions:
+			return self.default_rate
+
+		span = max(end for _, end, _ in self.completions) - min(start for start, _, _ in self.completions)
+		cost = sum(cost for _, _, cost in self.completions)
+
+		return cost / span if span > 0 and cost > 0 else self.default_rate
+
+
+	def load (self, lane):
+		return sum(cost for _, cost in self.outstanding[lane])
+
+
+	def submit (self, lane, cost, submit):
+		r"""
+		Calls `submit()` to create the job if admitted, returns the job or raises `AdmissionRejected`.
+		"""
+		with self.lock:
+			self.refresh()
+
+			load = self.load(lane)
+			budget = self.budgets[lane]
+			if budget and load > 0 and load + cost > budget:
+				raise AdmissionRejected(lane, max(1, math.ceil((load + cost - budget) / self.rate())))
+
+			job = submit()
+			self.outstanding[lane].append((job, cost))
+
+			return job
+
+
+	def stats (self):
+		with self.lock:
+			self.refresh()
+
+			return {
+				'rate': self.rate(),
+				'lanes': {lane: dict(load=self.load(lane), jobs=len(entries), budget=self.budgets[lane]) for lane, entries in self.outstanding.items()},
+			}
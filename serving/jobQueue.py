@@ -0,0 +1,212 @@
+
+import threading
+import concurrent.futures
+import time
+import uuid
+
+from .requestBatcher import BatchItem, RequestBatcher
+
+
+
+class JobCancelled (Exception):
+	pass
+
+
+class Job (BatchItem):
+	def __init__ (self, kind, params, key=None, size=1, total_steps=None):
+		super().__init__(kind, params, key=key, size=size)
+
+		self.id = uuid.uuid4().hex
+		self.status = 'queued'
+		self.step = 0
+		self.total_steps = total_steps
+		self.finished = None
+		self.cache_key = None
+		self.cancelled = False
+
+		# progress listeners, e.g. event streams, wait on `updated` for `version` to change
+		self.updated = threading.Condition()
+		self.version = 0
+		self.listeners = 0
+		self.preview = None
+
+
+	def touch (self):
+		with self.updated:
+			self.version += 1
+			self.updated.notify_all()
+
+
+	def waitForUpdate (self, version, timeout=None):
+		with self.updated:
+			self.updated.wait_for(lambda: self.version != version, timeout)
+
+			return self.version
+
+
+	def listen (self, delta=1):
+		with self.updated:
+			self.listeners += delta
+
+
+	def progress (self, step, preview=None):
+		self.step = step
+		if preview is not None:
+			self.preview = preview
+
+		self.touch()
+
+
+	def start (self):
+		# a job cancelled between being taken into a batch and its start is already finished
+		with self.updated:
+			if self.event.is_set():
+				return False
+
+			super().start()
+			self.status = 'running'
+			self.touch()
+
+		return True
+
+
+	def resolve (self, result):
+		# a job cancelled while running is already finished when its batch comes back
+		return self.finish('done', lambda: super(Job, self).resolve(result))
+
+
+	def reject (self, error):
+		return self.finish(None, lambda: super(Job, self).reject(error))
+
+
+	def finish (self, status, settle):
+		# check and finish under `updated`, so a cancellation racing with post-processing finishes the job once.
+		# Returns whether this call finished it
+		with self.updated:
+			if self.event.is_set():
+				return False
+
+			self.status = status or ('cancelled' if self.cancelled else 'failed')
+			self.finished = time.time()
+			settle()
+			self.touch()
+
+		return True
+
+
+class JobQueue (RequestBatcher):
+	r"""
+	A `RequestBatcher` whose items are addressable jobs, so clients can submit work and poll it later instead of
+	holding a connection open. Finished jobs are kept for `retention` seconds.
+
+	`postprocess(job, result)`, if provided, turns a runner result into the job result on a pool of `postprocess_threads`
+	threads, e.g. to encode images while the runner goes on with the next batch. Jobs are done after post-processing.
+
+	Jobs submitted with a `session` supersede the unfinished job of the same session, which gets cancelled.
+	"""
+
+	def __init__ (self, runner, window=0.05, max_batch_size=4, retention=600, threads=1, postprocess=None, postprocess_threads=4):
+		self.jobs = {}
+		self.sessions = {}
+		self.retention = retention
+
+		self.postprocess = postprocess
+		self.postprocessor = concurrent.futures.ThreadPoolExecutor(postprocess_threads, thread_name_prefix='postprocess') if postprocess else None
+
+		super().__init__(runner, window=window, max_batch_size=max_batch_size, threads=threads)
+
+
+	def submit (self, kind, params, key=None, size=1, total_steps=None, session=None):
+		job = Job(kind, params, key=key, size=size, total_steps=total_steps)
+		self.register(job, session)
+		self.enqueue(job)
+
+		return job
+
+
+	def complete (self, kind, params, result, session=None):
+		# register a job that is already done, e.g. served from a cache
+		job = Job(kind, params)
+		job.start()
+		job.resolve(result)
+		self.register(job, session)
+
+		return job
+
+
+	def register (self, job, session=None):
+		with self.condition:
+			self.prune()
+			self.jobs[job.id] = job
+
+			superseded = None
+			if session is not None:
+				superseded = self.sessions.get(session)
+				self.sessions[session] = job
+
+		if superseded is not None:
+			self.cancel(superseded)
+
+
+	def cancel (self, job):
+		r"""
+		Queued jobs are dropped. Running jobs are finished as cancelled right away, their batch stops at the next denoising
+		step once no job of it is left. Returns whether the job was unfinished.
+		"""
+		with self.condition:
+			if job.event.is_set():
+				return False
+
+			job.cancelled = True
+			self.pending = [item for item in self.pending if item is not job]
+
+		# the job may have been finished by post-processing in between
+		return job.reject(JobCancelled(f'job {job.id} is cancelled.'))
+
+
+	def settle (self, job, result):
+		if self.postprocess is None:
+			return super().settle(job, result)
+
+		self.postprocessor.submit(self.finish, job, result)
+
+
+	def finish (self, job, result):
+		try:
+			job.resolve(self.postprocess(job, result))
+		except Exception as error:
+			job.reject(error)
+
+
+	def get (self, id):
+		return self.jobs.get(id)
+
+
+	def position (self, job):
+		with self.condition:
+			for i, item in enumerate(self.pending):
+				if item is job:
+					return i
+
+		return None
+
+
+	def describe (self, job):
+		return {
+			'id': job.id,
+			'kind': job.kind,
+			'status': job.status,
+			'position': self.position(job),
+			'step': job.step,
+			'total_steps': job.total_steps,
+			'error': str(job.error) if job.error is not None else None,
+		}
+
+
+	def prune (self):
+		deadline = time.time() - self.retention
+		expired = [id for id, job in self.jobs.items() if job.finished is not None and job.finished < deadline]
+		for id in expired:
+			del self.jobs[id]
+
+		self.sessions = {session: job for session, job in self.sessions.items() if job.id in self.jobs}
@@ -0,0 +1,53 @@
+
+import threading
+import time
+
+
+
+class LazyModel:
+	r"""
+	A component built by `load()` on the first `get()`, from whichever thread asks first, while other callers wait.
+
+	A failed load raises in the callers that were waiting for it, and is tried again by the next `get()`.
+	"""
+
+	def __init__ (self, name, load):
+		self.name = name
+		self.load = load
+
+		self.value = None
+		self.status = 'unloaded'
+		self.error = None
+		self.seconds = None
+		self.lock = threading.Lock()
+
+
+	@property
+	def ready (self):
+		return self.status == 'ready'
+
+
+	def get (self):
+		if self.ready:
+			return self.value
+
+		with self.lock:
+			if not self.ready:
+				self.status = 'loading'
+				start = time.time()
+				try:
+					self.value = self.load()
+				except Exception as error:
+					self.status = 'failed'
+					self.error = f'{type(error).__name__}: {error}'
+					raise
+
+				self.seconds = time.time() - start
+				self.status = 'ready'
+				self.error = None
+
+		return self.value
+
+
+	def describe (self):
+		return dict(status=self.status, seconds=self.seconds, error=self.error)
@@ -0,0 +1,126 @@
+
+import contextlib
+import threading
+import time
+
+
+
+# seconds, from tokenization of one prompt to a whole generation
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 25, 60, 120)
+
+
+def formatLabels (labels):
+	if not labels:
+		return ''
+
+	return '{' + ','.join(f'{name}="{str(value)}"' for name, value in labels) + '}'
+
+
+def formatValue (value):
+	return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Histogram:
+	def __init__ (self, name, help, buckets=DEFAULT_BUCKETS):
+		self.name = name
+		self.help = help
+		self.buckets = tuple(buckets)
+
+		# label tuple -> [bucket counts, sum, count]
+		self.series = {}
+		self.lock = threading.Lock()
+
+
+	def observe (self, value, **labels):
+		key = tuple(sorted(labels.items()))
+		with self.lock:
+			series = self.series.get(key)
+			if series is None:
+				series = self.series[key] = [[0] * len(self.buckets), 0., 0]
+
+			for i, bound in enumerate(self.buckets):
+				if value <= bound:
+					series[0][i] += 1
+			series[1] += value
+			series[2] += 1
+
+
+	def render (self):
+		lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+		with self.lock:
+			for key, (counts, total, count) in sorted(self.series.items()):
+				for bound, n in zip(self.buckets, counts):
+					lines.append(f'{self.name}_bucket{formatLabels(key + (("le", formatValue(bound)),))} {n}')
+				lines.append(f'{self.name}_bucket{formatLabels(key + (("le", "+Inf"),))} {count}')
+				lines.append(f'{self.name}_sum{formatLabels(key)} {formatValue(total)}')
+				lines.append(f'{self.name}_count{formatLabels(key)} {count}')
+
+		return lines
+
+
+class Sampled:
+	r"""
+	A gauge or counter read from `sample()` at scrape time, which returns a value or a list of `(labels dict, value)`.
+	"""
+
+	def __init__ (self, name, help, sample, type='gauge'):
+		self.name = name
+		self.help = help
+		self.sample = sample
+		self.type = type
+
+
+	def render (self):
+		lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+
+		values = self.sample()
+		if not isinstance(values, list):
+			values = [({}, values)]
+
+		for labels, value in values:
+			lines.append(f'{self.name}{formatLabels(tuple(sorted(labels.items())))} {formatValue(value)}')
+
+		return lines
+
+
+class Metrics:
+	r"""
+	A small registry of histograms and sampled gauges, rendered in the Prometheus text exposition format.
+	"""
+
+	def __init__ (self):
+		self.metrics = []
+
+
+	def histogram (self, name, help, buckets=DEFAULT_BUCKETS):
+		metric = Histogram(name, help, buckets)
+		self.metrics.append(metric)
+
+		return metric
+
+
+	def sampled (self, name, help, sample, type='gauge'):
+		metric = Sampled(name, help, sample, type)
+		self.metrics.append(metric)
+
+		return metric
+
+
+	@contextlib.contextmanager
+	def timer (self, histogram, **labels):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			histogram.observe(time.perf_counter() - start, **labels)
+
+
+	def render (self):
+		lines = []
+		for metric in self.metrics:
+			try:
+				lines += metric.render()
+			except Exception as error:
+				lines.append(f'# {metric.name} is not available: {error}')
+
+		return '\n'.join(lines) + '\n'
@@ -0,0 +1,240 @@
+
+import collections
+import hashlib
+import threading
+import time
+import weakref
+import torch
+
+from pipeline_stable_diffusion import StableDiffusionPipeline
+from sdUtils import SequentialOffload
+from .pipelineRunner import PipelineRunner
+
+
+
+def pipelineModules (pipe):
+	return [module for module in (getattr(pipe, name, None) for name in pipe.config.keys()) if isinstance(module, torch.nn.Module)]
+
+
+def moduleBytes (module):
+	# memory of parameters and buffers
+	return sum(tensor.numel() * tensor.element_size() for tensor in list(module.parameters()) + list(module.buffers()))
+
+
+def uniqueBytes (modules):
+	return sum(moduleBytes(module) for module in {id(module): module for module in modules}.values())
+
+
+def moduleSignature (module):
+	# cheap to compare, modules of equal signatures are hashed
+	return (type(module).__name__,) + tuple((name, tuple(tensor.shape), str(tensor.dtype)) for name, tensor in module.state_dict().items())
+
+
+def moduleDigest (module):
+	digest = hashlib.sha256()
+	for name, tensor in module.state_dict().items():
+		digest.update(name.encode())
+		digest.update(tensor.detach().cpu().flatten().view(torch.uint8).numpy().tobytes())
+
+	return digest.hexdigest()
+
+
+def sameTokenizer (a, b):
+	return type(a) is type(b) and a.model_max_length == b.model_max_length and a.get_vocab() == b.get_vocab()
+
+
+class ModelEntry:
+	def __init__ (self, name, path):
+		self.name = name
+		self.path = path
+
+		self.runner = None
+		# 'device', 'offloaded' (in CPU memory) or 'unloaded'
+		self.location = 'unloaded'
+		self.bytes = 0
+		self.active = 0
+
+
+class ModelRegistry:
+	r"""
+	Runs batches on the pipeline of the `model` param of their items, one `PipelineRunner` per model, loaded on demand.
+
+	`models` maps model names to paths, `load(path, torch_dtype=...)` builds a pipeline in CPU memory which is then moved to `device`.
+	Components of a new pipeline whose weights (or vocabulary, for tokenizers) are identical to those of a loaded one are
+	replaced by the loaded instance, e.g. the VAE and text encoder of an inpainting variant of the base model. When the
+	pipelines on the device would take more than `memory_budget` bytes (0 for no limit, shared modules count once), the
+	least recently used idle ones are moved back to CPU memory (`eviction='offload'`, restored on their next batch) or
+	dropped (`eviction='unload'`). Modules still used by other pipelines on the device stay there. Pipelines on CPU
+	devices are always dropped. Loads and moves are serialized.
+
+	Weights are loaded in `dtype` on accelerators. Reduced precision on CPU devices, where half precision kernels are slow
+	or missing, keeps float32 weights and runs model calls under bfloat16 autocast instead.
+
+	With `sequential_offload`, pipelines stay in CPU memory and one model at a time goes to the device for its phase, by
+	a `SequentialOffload` shared by all pipelines, so the memory budget does not apply.
+
+	`switch_observer(model, action, seconds)` is called on every `load`, `restore`, `offload` and `unload`.
+	"""
+
+	def __init__ (self, models, load, default=None, device=None, dtype=torch.float32, memory_budget=0, eviction='offload',
+		sequential_offload=False, runner_options=None, stage_observer=None, switch_observer=None):
+		self.load = load
+		self.default = default or next(iter(models))
+		self.device = torch.device(device) if device else None
+		self.memory_budget = memory_budget
+		self.offload = eviction == 'offload' and self.device is not None and self.device.type != 'cpu'
+		on_cpu = self.device is None or self.device.type == 'cpu'
+		self.weight_dtype = torch.float32 if on_cpu else dtype
+		self.autocast_dtype = torch.bfloat16 if on_cpu and dtype != torch.float32 else None
+		self.offloader = SequentialOffload(self.device) if sequential_offload and self.device is not None and self.device.type != 'cpu' else None
+		self.runner_options = dict(runner_options or {})
+		self.stage_observer = stage_observer
+		self.switch_observer = switch_observer
+
+		# in least recently used order
+		self.entries = collections.OrderedDict((name, ModelEntry(name, path)) for name, path in models.items())
+		self.digests = weakref.WeakKeyDictionary()
+		self.lock = threading.Lock()
+
+
+	def __call__ (self, kind, items):
+		name = items[0].params.get('model') or self.default
+		runner = self.acquire(name)
+		try:
+			return runner(kind, items)
+		finally:
+			self.release(name)
+
+
+	def observe (self, entry, action, start):
+		print(f'model {entry.name}: {action} in {time.time() - start:.2f}s.')
+		if self.switch_observer:
+			self.switch_observer(entry.name, action, time.time() - start)
+
+
+	def deviceModules (self, exclude=None):
+		return [module for entry in self.entries.values() if entry.location == 'device' and entry is not exclude
+			for module in pipelineModules(entry.runner.pipe)]
+
+
+	def digest (self, module):
+		if module not in self.digests:
+			self.digests[module] = moduleDigest(module)
+
+		return self.digests[module]
+
+
+	def share (self, pipe):
+		# replace components of `pipe` by identical ones of loaded pipelines, returns the bytes saved
+		loaded = [entry.runner.pipe for entry in self.entries.values() if entry.runner is not None]
+		saved = 0
+		for name in pipe.config.keys():
+			component = getattr(pipe, name, None)
+			if isinstance(component, torch.nn.Module):
+				signature = moduleSignature(component)
+				candidates = [getattr(other, name, None) for other in loaded]
+				candidates = [c for c in candidates if isinstance(c, torch.nn.Module) and moduleSignature(c) == signature]
+				shared = next((c for c in candidates if self.digest(c) == self.digest(component)), None)
+				if shared is not None:
+					saved += moduleBytes(component)
+			elif hasattr(component, 'get_vocab'):
+				shared = next((getattr(other, name) for other in loaded if sameTokenizer(getattr(other, name, None), component)), None)
+			else:
+				continue
+
+			if shared is not None:
+				setattr(pipe, name, shared)
+
+		return saved
+
+
+	def evict (self, entry):
+		# make room on the device for the modules of `entry`
+		if not self.memory_budget or self.offloader is not None:
+			return
+
+		needed = pipelineModules(entry.runner.pipe)
+		for victim in list(self.entries.values()):
+			if uniqueBytes(self.deviceModules() + needed) <= self.memory_budget:
+				return
+			if victim.active > 0 or victim.location != 'device':
+				continue
+
+			start = time.time()
+			# cached embeddings of the evicted text encoder would hold device memory, or go stale once it is dropped
+			StableDiffusionPipeline.embedding_cache.clear(victim.runner.pipe._text_encoder_key)
+			if self.offload:
+				staying = set(id(module) for module in self.deviceModules(exclude=victim))
+				for module in pipelineModules(victim.runner.pipe):
+					if id(module) not in staying:
+						module.to('cpu')
+				# traced graphs are bound to the device of the weights
+				victim.runner.pipe.clear_compiled_modules()
+				victim.location = 'offloaded'
+				self.observe(victim, 'offload', start)
+			else:
+				victim.runner.close()
+				victim.runner = None
+				victim.location = 'unloaded'
+				self.observe(victim, 'unload', start)
+
+		print(f'models on the device take {uniqueBytes(self.deviceModules() + needed) / 2**20:.0f}MB, beyond the budget of',
+			f'{self.memory_budget / 2**20:.0f}MB, the others are running.')
+
+
+	def bringIn (self, entry):
+		start = time.time()
+		action = 'restore'
+		if entry.runner is None:
+			pipe = self.load(entry.path, torch_dtype=self.weight_dtype)
+			pipe.autocast_dtype = self.autocast_dtype
+			saved = self.share(pipe)
+			if saved:
+				print(f'model {entry.name}: {saved / 2**20:.0f}MB of modules are shared with loaded models.')
+
+			entry.bytes = uniqueBytes(pipelineModules(pipe))
+			if self.offloader is not None:
+				pipe.enable_sequential_offload(offloader=self.offloader)
+			entry.runner = PipelineRunner(pipe, stage_observer=self.stage_observer, **self.runner_options)
+			action = 'load'
+
+		self.evict(entry)
+		if self.device is not None and self.offloader is None:
+			entry.runner.pipe.to(self.device)
+		entry.location = 'device'
+
+		self.observe(entry, action, start)
+
+
+	def acquire (self, name):
+		with self.lock:
+			entry = self.entries.get(name)
+			if entry is None:
+				raise ValueError(f'unknown model: {name}, should be one of {", ".join(self.entries)}.')
+
+			if entry.location != 'device':
+				self.bringIn(entry)
+
+			entry.active += 1
+			self.entries.move_to_end(name)
+
+			return entry.runner
+
+
+	def release (self, name):
+		with self.lock:
+			self.entries[name].active -= 1
+
+
+	def info (self, name=None):
+		name = name or self.default
+		runner = self.acquire(name)
+		try:
+			return runner.info()
+		finally:
+			self.release(name)
+
+
+	def stats (self):
+		with self.lock:
+			return [dict(model=entry.name, location=entry.location, bytes=entry.bytes, active=entry.active) for entry in self.entries.values()]
@@ -0,0 +1,195 @@
+
+import torch
+from transformers import CLIPTokenizer
+
+from pipeline_stable_diffusion import StableDiffusionPipeline
+from sdUtils import tinyModels
+from .stepEngine import StepEngine
+
+
+
+def loadPipeline (model_path, device=None, torch_dtype=torch.float32, token=None):
+	# `tiny` and `tiny-inpainting` build small random-weight pipelines, for running without checkpoints or a GPU
+	if model_path in tinyModels.TINY_MODELS:
+		pipe = tinyModels.buildTinyPipeline(inpainting=model_path == 'tiny-inpainting')
+		for module in (pipe.unet, pipe.vae, pipe.text_encoder):
+			module.to(dtype=torch_dtype)
+	else:
+		pipe = StableDiffusionPipeline.from_pretrained(model_path, use_auth_token=token, torch_dtype=torch_dtype)
+
+	if device:
+		pipe.to(device)
+
+	return pipe
+
+
+def loadTokenizer (model_path, token=None):
+	if model_path in tinyModels.TINY_MODELS:
+		return tinyModels.buildTinyTokenizer()
+
+	return CLIPTokenizer.from_pretrained(model_path, subfolder='tokenizer', use_auth_token=token)
+
+
+class PipelineRunner:
+	r"""
+	Runs batches of jobs on one pipeline, as the runner of a `JobQueue` or inside a pool worker.
+
+	Items need `key`, `params`, `size`, `listeners`, `cancelled` and `progress(step, preview)`, as `Job` has. A batch
+	stops denoising once all of its items are cancelled.
+
+	Pipeline calls go through a `StepEngine`, so batches submitted from several threads share denoising steps, with at
+	most `step_batch_size` images in one UNet call. `stage_observer` and `synchronize_stages` are set on the pipeline, to
+	time its stages, and so are `vae_tiling_pixels` and `vae_tile_size`. With `compiled`, the UNet and VAE decoder run
+	through traced graphs, `compile_cache_size` of them per module.
+	"""
+
+	def __init__ (self, pipe, decode_batch_size=4, preview_steps=5, step_batch_size=8, stage_observer=None, synchronize_stages=False,
+		vae_tiling_pixels=None, vae_tile_size=512, compiled=False, compile_cache_size=16):
+		self.pipe = pipe
+		self.pipe.stage_observer = stage_observer
+		self.pipe.synchronize_stages = synchronize_stages
+		self.pipe.vae_tiling_pixels = vae_tiling_pixels
+		self.pipe.vae_tile_size = vae_tile_size
+		if compiled:
+			self.pipe.enable_compiled_modules(cache_size=compile_cache_size)
+		self.decode_batch_size = decode_batch_size
+		self.preview_steps = preview_steps
+		self.engine = StepEngine(pipe, max_batch_size=step_batch_size)
+
+		self.runners = {
+			'paint':	self.runPaint,
+			'img2img':	self.runImg2img,
+			'inpaint':	self.runInpaint,
+			'decode':	self.runDecode,
+		}
+
+
+	def __call__ (self, kind, items):
+		return self.runners[kind](items)
+
+
+	def close (self):
+		self.engine.close()
+
+
+	def info (self):
+		return {
+			'latent_channels': self.pipe.vae.config.latent_channels,
+			'vae_scale_factor': self.pipe.vae_scale_factor,
+		}
+
+
+	def createGenerator (self, seed):
+		device = self.pipe._execution_device
+		return torch.Generator('cpu' if device.type == 'mps' else device).manual_seed(seed)
+
+
+	def cancelledCallback (self, items):
+		return lambda: all(item.cancelled for item in items)
+
+
+	def progressCallback (self, items):
+		def callback (step, timestep, latents):
+			offset = 0
+			for item in items:
+				end = offset + item.size
+
+				# previews are only worth computing for jobs someone is streaming
+				preview = None
+				if item.listeners > 0 and (step + 1) % self.preview_steps == 0:
+					preview = self.pipe.preview_latents(latents[offset:end])
+
+				item.progress(step + 1, preview)
+				offset = end
+
+		return callback
+
+
+	def finish (self, request, return_latents=False):
+		# only VAE decoding occupies the engine, PIL conversion runs on the calling thread
+		result = self.engine.call(lambda: self.pipe.finish_denoising(request, output_type='np', return_latents=return_latents))
+		with self.pipe.stage_timer('numpy_to_pil', len(result['images'])):
+			result['images'] = self.pipe.numpy_to_pil(result['images'])
+
+		return result
+
+
+	def runPaint (self, items):
+		width, height, n_steps, guidance_window, feature_reuse, scheduler = (items[0].params.get(name)
+			for name in ('width', 'height', 'n_steps', 'guidance_window', 'feature_reuse', 'scheduler'))
+
+		def prepare ():
+			prompts, neg_prompts, latents, generators = [], [], [], []
+			for item in items:
+				params = item.params
+				prompts += [params['prompt']] * params['multi']
+				neg_prompts += [params['neg_prompt'] or ''] * params['multi']
+				# draw noise per request, initial and of ancestral steps, so a seed reproduces the same images no matter
+				# which batch it lands in
+				generator = self.createGenerator(params['seed'])
+				latents.append(self.pipe.sample_noise(params['multi'], height, width, generator=generator))
+				generators += [generator] * params['multi']
+
+			return self.pipe.prepare_generate(prompts, negative_prompt=neg_prompts, num_inference_steps=n_steps, width=width, height=height,
+				latents=torch.cat(latents), generator=generators, guidance_window=guidance_window, feature_reuse_interval=feature_reuse, scheduler=scheduler, callback=self.progressCallback(items),
+				cancelled=self.cancelledCallback(items))
+
+		request = self.engine.call(prepare)
+		self.engine.denoise(request)
+
+		return_latents = any(item.params['latents'] for item in items)
+		result = self.finish(request, return_latents=return_latents)
+
+		results = []
+		offset = 0
+		for item in items:
+			end = offset + item.params['multi']
+			results.append(dict(images=result['images'][offset:end], latents=result['latents'][offset:end] if item.params['latents'] else None))
+			offset = end
+
+		return results
+
+
+	def runImg2img (self, items):
+		# images of one size share the VAE encoding and denoising, each one is noised by the generator of its seed
+		params = items[0].params
+		request = self.engine.call(lambda: self.pipe.prepare_convert([item.params['prompt'] for item in items],
+			init_image=[item.params['image'] for item in items], num_inference_steps=params['n_steps'], strength=params['strength'],
+			guidance_window=params.get('guidance_window'), feature_reuse_interval=params.get('feature_reuse'), scheduler=params.get('scheduler'),
+			generator=[self.createGenerator(item.params['seed']) for item in items], callback=self.progressCallback(items),
+			cancelled=self.cancelledCallback(items)))
+		self.engine.denoise(request)
+
+		return_latents = any(item.params['latents'] is not None for item in items)
+		result = self.finish(request, return_latents=return_latents)
+
+		return [dict(images=result['images'][i:i + 1], latents=result['latents'][i:i + 1] if item.params['latents'] is not None else None)
+			for i, item in enumerate(items)]
+
+
+	def runInpaint (self, items):
+		params = items[0].params
+		request = self.engine.call(lambda: self.pipe.prepare_inpaint(params['prompt'], image=params['image'], mask_image=params['mask'],
+			num_inference_steps=params['n_steps'], guidance_window=params.get('guidance_window'), feature_reuse_interval=params.get('feature_reuse'),
+			scheduler=params.get('scheduler'), callback=self.progressCallback(items),
+			cancelled=self.cancelledCallback(items)))
+		self.engine.denoise(request)
+
+		return [self.finish(request)]
+
+
+	def runDecode (self, items):
+		# latents of all batched requests share one pass, chunked by `decode_batch_size`
+		latents = torch.cat([item.params['latents'] for item in items])
+		result = self.engine.call(lambda: self.pipe.decode(latents, batch_size=self.decode_batch_size, output_type='np'))
+		with self.pipe.stage_timer('numpy_to_pil', len(result['images'])):
+			result['images'] = self.pipe.numpy_to_pil(result['images'])
+
+		results = []
+		offset = 0
+		for item in items:
+			end = offset + item.size
+			results.append(dict(images=result['images'][offset:end]))
+			offset = end
+
+		return results
@@ -0,0 +1,134 @@
+
+import threading
+import time
+
+
+
+class BatchItem:
+	def __init__ (self, kind, params, key=None, size=1):
+		self.kind = kind
+		self.params = params
+		self.key = key
+		self.size = size
+		self.arrival = time.time()
+		self.started = None
+
+		self.result = None
+		self.error = None
+		self.event = threading.Event()
+
+
+	def start (self):
+		# returns whether the item is to run, subclasses decline items finished before their batch runs
+		self.started = time.time()
+
+		return True
+
+
+	def resolve (self, result):
+		self.result = result
+		self.event.set()
+
+
+	def reject (self, error):
+		self.error = error
+		self.event.set()
+
+
+	def wait (self, timeout=None):
+		if not self.event.wait(timeout):
+			raise TimeoutError(f'{self.kind} request is not finished in {timeout} seconds.')
+
+		if self.error is not None:
+			raise self.error
+
+		return self.result
+
+
+class RequestBatcher:
+	r"""
+	Serializes pipeline work onto worker threads and groups compatible requests into batches.
+
+	Requests of the same `kind` and a non-None `key` are compatible. The head request of the queue is held for at most
+	`window` seconds to let compatible requests join, or less if `max_batch_size` is reached (sizes are counted in
+	images). `runner(kind, items)` is called on a worker thread and returns one result per item. With `threads` > 1, that
+	many batches are run concurrently, for runners that can overlap them.
+	"""
+
+	def __init__ (self, runner, window=0.05, max_batch_size=4, threads=1):
+		self.runner = runner
+		self.window = window
+		self.max_batch_size = max_batch_size
+
+		self.pending = []
+		self.condition = threading.Condition()
+
+		self.threads = [threading.Thread(target=self.loop, daemon=True) for _ in range(threads)]
+		for thread in self.threads:
+			thread.start()
+
+
+	def submit (self, kind, params, key=None, size=1):
+		item = BatchItem(kind, params, key=key, size=size)
+		self.enqueue(item)
+
+		return item
+
+
+	def enqueue (self, item):
+		with self.condition:
+			self.pending.append(item)
+			self.condition.notify_all()
+
+
+	def compatible (self, head, item):
+		return head.key is not None and item.kind == head.kind and item.key == head.key
+
+
+	def takeBatch (self):
+		with self.condition:
+			# the head is looked up again after every wait, another worker thread may have taken it meanwhile
+			while True:
+				while not self.pending:
+					self.condition.wait()
+
+				head = self.pending[0]
+				if head.key is None:
+					break
+
+				size = sum(item.size for item in self.pending if self.compatible(head, item))
+				remaining = head.arrival + self.window - time.time()
+				if size >= self.max_batch_size or remaining <= 0:
+					break
+
+				self.condition.wait(remaining)
+
+			batch = [head]
+			size = head.size
+			for item in self.pending[1:]:
+				if self.compatible(head, item) and size + item.size <= self.max_batch_size:
+					batch.append(item)
+					size += item.size
+
+			self.pending = [item for item in self.pending if not any(item is b for b in batch)]
+
+			return batch
+
+
+	def loop (self):
+		while True:
+			batch = [item for item in self.takeBatch() if item.start()]
+			if not batch:
+				continue
+
+			try:
+				results = self.runner(batch[0].kind, batch)
+				for item, result in zip(batch, results):
+					self.settle(item, result)
+			except Exception as error:
+				for item in batch:
+					item.reject(error)
+
+
+	def settle (self, item, result):
+		item.resolve(result)
@@ -0,0 +1,122 @@
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+
+class ResultCache:
+	r"""
+	Disk backed LRU store of encoded responses, for requests whose output is fully determined by their parameters.
+
+	Each entry is a body file `<key>.bin` and a `<key>.json` with its mimetype and headers. Entries are evicted in least
+	recently used order once their bodies exceed `max_bytes`. The use order survives restarts through file mtimes.
+	"""
+
+	def __init__ (self, directory, max_bytes):
+		self.directory = directory
+		self.max_bytes = max_bytes
+
+		self.entries = OrderedDict()
+		self.total_bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+
+		os.makedirs(directory, exist_ok=True)
+		self.load()
+
+
+	@staticmethod
+	def keyOf (params):
+		return hashlib.sha256(json.dumps(params, sort_keys=True, ensure_ascii=True).encode('ascii')).hexdigest()
+
+
+	def path (self, key, ext):
+		return os.path.join(self.directory, f'{key}.{ext}')
+
+
+	def load (self):
+		entries = []
+		for name in os.listdir(self.directory):
+			key, ext = os.path.splitext(name)
+			if ext == '.bin' and os.path.exists(self.path(key, 'json')):
+				stat = os.stat(self.path(key, 'bin'))
+				entries.append((stat.st_mtime, key, stat.st_size))
+
+		for _, key, size in sorted(entries):
+			self.entries[key] = size
+			self.total_bytes += size
+
+		with self.lock:
+			self.evict()
+
+
+	def get (self, key):
+		with self.lock:
+			if key not in self.entries:
+				self.misses += 1
+				return None
+
+			try:
+				with open(self.path(key, 'bin'), 'rb') as file:
+					body = file.read()
+				with open(self.path(key, 'json'), 'r') as file:
+					meta = json.load(file)
+			except OSError:
+				self.remove(key)
+				self.misses += 1
+				return None
+
+			os.utime(self.path(key, 'bin'))
+			self.entries.move_to_end(key)
+			self.hits += 1
+
+			return body, meta['mimetype'], meta['headers']
+
+
+	def put (self, key, body, mimetype, headers={}):
+		if len(body) > self.max_bytes:
+			return
+
+		with self.lock:
+			if key in self.entries:
+				self.remove(key)
+
+			# write to temporary names first, so a crash never leaves a partial entry behind
+			for ext, data, mode in [('json', json.dumps(dict(mimetype=mimetype, headers=headers)), 'w'), ('bin', body, 'wb')]:
+				with open(self.path(key, ext) + '.tmp', mode) as file:
+					file.write(data)
+				os.replace(self.path(key, ext) + '.tmp', self.path(key, ext))
+
+			self.entries[key] = len(body)
+			self.total_bytes += len(body)
+
+			self.evict()
+
+
+	def remove (self, key):
+		self.total_bytes -= self.entries.pop(key)
+
+		for ext in ('bin', 'json'):
+			try:
+				os.remove(self.path(key, ext))
+			except FileNotFoundError:
+				pass
+
+
+	def evict (self):
+		while self.total_bytes > self.max_bytes and self.entries:
+			self.remove(next(iter(self.entries)))
+
+
+	def stats (self):
+		return {
+			'size': len(self.entries),
+			'bytes': self.total_bytes,
+			'max_bytes': self.max_bytes,
+			'hits': self.hits,
+			'misses': self.misses,
+		}
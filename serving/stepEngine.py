@@ -0,0 +1,122 @@
+import threading
+
+from pipeline_stable_diffusion import DenoisingCancelled
+from .requestBatcher import BatchItem
+
+
+
+class StepEngine:
+	r"""
+	Runs all pipeline work of a `PipelineRunner` on one thread, batching the denoising loop per step instead of per
+	request.
+
+	Denoising requests (`DenoisingRequest` of the pipeline) join the running set at the next UNet call and leave as soon as
+	their last step is done, instead of waiting for a whole batch to finish. Running requests of the same `shape_key`
+	share one UNet call of at most `max_batch_size` images. Other work submitted by `call`, e.g. prompt encoding of new
+	requests or VAE decoding of finished ones, runs between steps. Cancelled requests are dropped before the next step.
+	"""
+
+	def __init__ (self, pipe, max_batch_size=8):
+		self.pipe = pipe
+		self.max_batch_size = max_batch_size
+
+		self.calls = []
+		self.waiting = []
+		self.running = []
+		self.closed = False
+		self.condition = threading.Condition()
+
+		self.thread = threading.Thread(target=self.loop, daemon=True)
+		self.thread.start()
+
+
+	def call (self, fn):
+		# run `fn` on the engine thread and return its result
+		item = BatchItem('call', fn)
+		with self.condition:
+			self.calls.append(item)
+			self.condition.notify_all()
+
+		return item.wait()
+
+
+	def denoise (self, request):
+		# run all remaining steps of `request` alongside other running requests
+		item = BatchItem('denoise', request, key=request.shape_key, size=request.latents.shape[0])
+		with self.condition:
+			self.waiting.append(item)
+			self.condition.notify_all()
+
+		return item.wait()
+
+
+	def close (self):
+		# the engine thread exits once queued work is done
+		with self.condition:
+			self.closed = True
+			self.condition.notify_all()
+
+
+	def dropCancelled (self):
+		with self.condition:
+			cancelled = [item for item in self.waiting + self.running if item.params.is_cancelled]
+			self.waiting = [item for item in self.waiting if not any(item is c for c in cancelled)]
+			self.running = [item for item in self.running if not any(item is c for c in cancelled)]
+
+		for item in cancelled:
+			item.reject(DenoisingCancelled(f'denoising is cancelled at step {item.params.step_index}.'))
+
+
+	def admit (self):
+		# in arrival order, a request waits while running requests of its shape fill up a UNet call
+		with self.condition:
+			for item in list(self.waiting):
+				load = sum(running.size for running in self.running if running.key == item.key)
+				if load == 0 or load + item.size <= self.max_batch_size:
+					self.waiting.remove(item)
+					self.running.append(item)
+					item.start()
+
+
+	def step (self):
+		groups = {}
+		for item in self.running:
+			if not item.params.done:
+				groups.setdefault(item.key, []).append(item)
+
+		for items in groups.values():
+			try:
+				self.pipe.denoise_step([item.params for item in items])
+			except Exception as error:
+				for item in items:
+					item.reject(error)
+
+		finished = [item for item in self.running if item.event.is_set() or item.params.done]
+		with self.condition:
+			self.running = [item for item in self.running if not any(item is f for f in finished)]
+
+		for item in finished:
+			if not item.event.is_set():
+				item.resolve(item.params)
+
+
+	def loop (self):
+		while True:
+			with self.condition:
+				while not (self.calls or self.waiting or self.running):
+					if self.closed:
+						return
+					self.condition.wait()
+
+				calls, self.calls = self.calls, []
+
+			for item in calls:
+				item.start()
+				try:
+					item.resolve(item.params())
+				except Exception as error:
+					item.reject(error)
+
+			self.dropCancelled()
+			self.admit()
+			self.step()
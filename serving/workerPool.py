@@ -0,0 +1,307 @@
+
+import os
+import queue
+import threading
+import time
+import uuid
+import multiprocessing
+import torch
+
+from pipeline_stable_diffusion import StableDiffusionPipeline
+from .modelRegistry import ModelRegistry
+
+
+class RemoteItem:
+	r"""
+	Stands in for a `Job` inside a worker process, progress is reported back to the dispatcher.
+	"""
+
+	def __init__ (self, outbox, batch_id, index, params, key=None, size=1, listeners=0, cancelled=False):
+		self.outbox = outbox
+		self.batch_id = batch_id
+		self.index = index
+		self.params = params
+		self.key = key
+		self.size = size
+		self.listeners = listeners
+		self.cancelled = cancelled
+
+
+	def progress (self, step, preview=None):
+		self.outbox.put(('progress', self.batch_id, self.index, step, preview))
+
+
+def workerMain (inbox, outbox, models, loader, device, cpus, threads, embedding_cache_size, registry_options, observe_stages, observe_switches):
+	# entry of the worker process
+	if cpus and hasattr(os, 'sched_setaffinity'):
+		os.sched_setaffinity(0, cpus)
+	if threads:
+		torch.set_num_threads(threads)
+
+	StableDiffusionPipeline.embedding_cache.resize(embedding_cache_size)
+
+	stage_observer = (lambda stage, seconds, batch_size: outbox.put(('observe', stage, seconds, batch_size))) if observe_stages else None
+	switch_observer = (lambda model, action, seconds: outbox.put(('switch', model, action, seconds))) if observe_switches else None
+	runner = ModelRegistry(models, loader, device=device, stage_observer=stage_observer, switch_observer=switch_observer, **registry_options)
+
+	# the default model is loaded before the worker is ready, others on their first batch
+	outbox.put(('ready', runner.info()))
+
+	running = {}
+
+	def execute (batch_id, kind, items):
+		try:
+			outbox.put(('done', batch_id, runner(kind, items)))
+		except Exception as error:
+			# exceptions are not always picklable, the dispatcher rebuilds them from the message
+			outbox.put(('failed', batch_id, f'{type(error).__name__}: {error}'))
+		finally:
+			del running[batch_id]
+
+	while True:
+		message = inbox.get()
+		if message[0] == 'run':
+			# batches run concurrently, the runner's step engine merges their denoising steps
+			_, batch_id, kind, specs = message
+			running[batch_id] = [RemoteItem(outbox, batch_id, i, **spec) for i, spec in enumerate(specs)]
+			threading.Thread(target=execute, args=(batch_id, kind, running[batch_id]), daemon=True).start()
+		elif message[0] == 'listen':
+			_, batch_id, index, listeners = message
+			items = running.get(batch_id)
+			if items:
+				items[index].listeners = listeners
+		elif message[0] == 'cancel':
+			_, batch_id, index = message
+			items = running.get(batch_id)
+			if items:
+				items[index].cancelled = True
+		elif message[0] == 'stop':
+			break
+
+
+class RemoteBatch:
+	def __init__ (self, items):
+		self.id = uuid.uuid4().hex
+		self.items = items
+		self.size = sum(item.size for item in items)
+		self.listeners = [item.listeners for item in items]
+		self.cancelled = [item.cancelled for item in items]
+
+		self.results = None
+		self.error = None
+		self.event = threading.Event()
+
+
+class Worker:
+	def __init__ (self, index, device, cpus=None, threads=None):
+		self.index = index
+		self.device = device
+		self.cpus = cpus
+		self.threads = threads
+
+		self.process = None
+		self.inbox = None
+		self.ready = False
+		self.info = None
+		self.load = 0
+		self.restarts = 0
+		self.batches = {}
+
+
+class WorkerPool:
+	r"""
+	Runs pipeline batches in worker processes, each pinned to a device or a set of CPU cores, with a `ModelRegistry` of
+	`models` per process.
+
+	`loader(path, torch_dtype=...)` builds a pipeline in the worker, it must be picklable (e.g. a `functools.partial` of a module level
+	function), `registry_options` are passed to the registries. `run(kind, items)`, or calling the pool, has the signature of a `RequestBatcher` runner, it sends the batch to the ready
+	worker with the fewest images in flight and blocks until results come back. A worker runs the batches it receives
+	concurrently. Crashed workers fail their in-flight
+	batches and are restarted with an exponential backoff.
+
+	CPU workers get `threads` cores each, taken in order from the cores available to this process. Stage times of the
+	worker pipelines are reported to `stage_observer`, and model switches to `switch_observer` in this process.
+	"""
+
+	def __init__ (self, models, loader, devices, threads=None, embedding_cache_size=256, registry_options=None, stage_observer=None,
+		switch_observer=None, max_backoff=60):
+		self.models = models
+		self.loader = loader
+		self.embedding_cache_size = embedding_cache_size
+		self.registry_options = dict(registry_options or {})
+		self.stage_observer = stage_observer
+		self.switch_observer = switch_observer
+		self.max_backoff = max_backoff
+
+		self.context = multiprocessing.get_context('spawn')
+		self.condition = threading.Condition()
+
+		cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+		cpu_workers = sum(1 for device in devices if device == 'cpu')
+		threads = threads or max(1, len(cores) // max(cpu_workers, 1))
+
+		self.workers = []
+		cpu_index = 0
+		for i, device in enumerate(devices):
+			cpus = None
+			if device == 'cpu':
+				cpus = [cores[(cpu_index * threads + c) % len(cores)] for c in range(threads)]
+				cpu_index += 1
+
+			self.workers.append(Worker(i, device, cpus=cpus, threads=threads if device == 'cpu' else None))
+
+		for worker in self.workers:
+			threading.Thread(target=self.supervise, args=(worker,), daemon=True).start()
+
+
+	def __len__ (self):
+		return len(self.workers)
+
+
+	def spawn (self, worker):
+		inbox, outbox = self.context.Queue(), self.context.Queue()
+		process = self.context.Process(target=workerMain, daemon=True,
+			args=(inbox, outbox, self.models, self.loader, worker.device, worker.cpus, worker.threads, self.embedding_cache_size, self.registry_options,
+				self.stage_observer is not None, self.switch_observer is not None))
+		process.start()
+
+		worker.process = process
+		worker.inbox = inbox
+
+		return outbox
+
+
+	def supervise (self, worker):
+		backoff = 1
+		while True:
+			started = time.time()
+			outbox = self.spawn(worker)
+			print(f'worker {worker.index} started on {worker.device}, pid: {worker.process.pid}')
+
+			while True:
+				try:
+					message = outbox.get(timeout=1)
+				except queue.Empty:
+					if not worker.process.is_alive():
+						break
+					self.sync(worker)
+					continue
+
+				self.handle(worker, message)
+
+			with self.condition:
+				worker.ready = False
+				batches = list(worker.batches.values())
+				worker.batches.clear()
+
+			error = RuntimeError(f'worker {worker.index} exited with code {worker.process.exitcode}.')
+			for batch in batches:
+				batch.error = error
+				batch.event.set()
+
+			# reset the backoff once a worker has stayed up for a while
+			if time.time() - started > self.max_backoff:
+				backoff = 1
+			print(f'worker {worker.index} exited with code {worker.process.exitcode}, restarting in {backoff}s.')
+			time.sleep(backoff)
+			backoff = min(backoff * 2, self.max_backoff)
+			worker.restarts += 1
+
+
+	def handle (self, worker, message):
+		if message[0] == 'ready':
+			with self.condition:
+				worker.info = message[1]
+				worker.ready = True
+				self.condition.notify_all()
+			return
+
+		if message[0] == 'observe':
+			self.stage_observer(*message[1:])
+			return
+
+		if message[0] == 'switch':
+			self.switch_observer(*message[1:])
+			return
+
+		batch = worker.batches.get(message[1])
+		if batch is None:
+			return
+
+		if message[0] == 'progress':
+			_, _, index, step, preview = message
+			batch.items[index].progress(step, preview)
+
+			self.sync(worker)
+		elif message[0] == 'done':
+			batch.results = message[2]
+			batch.event.set()
+		elif message[0] == 'failed':
+			batch.error = RuntimeError(message[2])
+			batch.event.set()
+
+
+	def sync (self, worker):
+		# item states changed in this process are forwarded on progress and once a second,
+		# e.g. previews start one step after a client connects
+		for batch in list(worker.batches.values()):
+			for index, item in enumerate(batch.items):
+				if item.listeners != batch.listeners[index]:
+					batch.listeners[index] = item.listeners
+					worker.inbox.put(('listen', batch.id, index, item.listeners))
+
+				if item.cancelled and not batch.cancelled[index]:
+					batch.cancelled[index] = True
+					worker.inbox.put(('cancel', batch.id, index))
+
+
+	def acquire (self, batch):
+		with self.condition:
+			self.condition.wait_for(lambda: any(worker.ready for worker in self.workers))
+
+			worker = min((worker for worker in self.workers if worker.ready), key=lambda worker: worker.load)
+			worker.load += batch.size
+			worker.batches[batch.id] = batch
+
+			return worker
+
+
+	def release (self, worker, batch):
+		with self.condition:
+			worker.load -= batch.size
+			worker.batches.pop(batch.id, None)
+
+
+	def run (self, kind, items):
+		batch = RemoteBatch(items)
+		worker = self.acquire(batch)
+		try:
+			specs = [dict(params=item.params, key=item.key, size=item.size, listeners=item.listeners, cancelled=item.cancelled) for item in items]
+			worker.inbox.put(('run', batch.id, kind, specs))
+
+			batch.event.wait()
+		finally:
+			self.release(worker, batch)
+
+		if batch.error is not None:
+			raise batch.error
+
+		return batch.results
+
+
+	def __call__ (self, kind, items):
+		return self.run(kind, items)
+
+
+	def info (self):
+		# model properties reported by the first worker that loaded its pipeline
+		with self.condition:
+			self.condition.wait_for(lambda: any(worker.info for worker in self.workers))
+
+			return next(worker.info for worker in self.workers if worker.info)
+
+
+	def stats (self):
+		with self.condition:
+			return [dict(index=worker.index, device=worker.device, ready=worker.ready, load=worker.load, restarts=worker.restarts,
+				pid=worker.process.pid if worker.process else None) for worker in self.workers]